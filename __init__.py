@@ -1 +1,14 @@
-from .siglican import *
\ No newline at end of file
+# Pelican imports the plugin and calls register() on every run, so only the
+# entry points live here: the generator, and the image, template and markdown
+# libraries it needs, are imported when Pelican asks for generators and by
+# each build phase that uses them.
+
+
+def get_generators(generators):
+    from .siglican import SigalGalleryGenerator
+    return SigalGalleryGenerator
+
+
+def register():
+    from pelican import signals
+    signals.get_generators.connect(get_generators)
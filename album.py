@@ -33,11 +33,12 @@ import os
 import logging
 
 from collections import defaultdict
-from PIL import Image as PILImage
+from datetime import datetime
 
-from .compat import strxfrm, UnicodeMixin, url_quote
+from . import instrument
+from .compat import makedirs, strxfrm, UnicodeMixin, url_quote
 from .utils import read_markdown, url_from_path
-from .image import process_image, get_exif_tags
+from .exif import get_exif_tags
 
 class Media(UnicodeMixin):
     """Base Class for media files.
@@ -50,34 +51,62 @@ class Media(UnicodeMixin):
     - ``big``: If not None, location of the unmodified image.
     - ``exif``: If not None contains a dict with the most common tags. For more
         information, see :ref:`simple-exif-data`.
-    - ``raw_exif``: If not ``None``, it contains the raw EXIF tags.
+    - ``raw_exif``: If not ``None``, it contains the raw EXIF tags (only the
+        tags used for ``exif`` when they were read from the JPEG header).
+    - ``duplicate_of``: If not None, the :class:`Media` with identical content
+        whose derivatives are shared with this one.
+    - ``sprite``: If not None, the :class:`~siglican.sprites.Sprite` giving the
+        position of the thumbnail in the album's sprite sheet.
 
     """
 
     type = ''
     extensions = ()
 
-    def __init__(self, filename, path, settings):
+    def __init__(self, filename, path, settings, metadata=None):
         self.src_filename = self.filename = self.url = filename
         self.path = path
         self.settings = settings
         
+        self.relpath = os.path.normpath(os.path.join(path, filename))
         self.src_path = os.path.join(settings['SIGLICAN_SOURCE'], path, filename)
         self.dst_path = os.path.join(settings['SIGLICAN_DESTINATION'], path, filename)
         
         self.thumb_name = get_thumb(self.settings, self.filename)
         self.thumb_path = os.path.join(settings['SIGLICAN_DESTINATION'], path, self.thumb_name)
-        
+
+        self.big = self.orig_path = None
+        if settings['SIGLICAN_KEEP_ORIG']:
+            orig_name = os.path.join(settings['SIGLICAN_ORIG_DIR'], filename)
+            self.big = url_from_path(orig_name)
+            self.orig_path = os.path.join(settings['SIGLICAN_DESTINATION'],
+                                          path, orig_name)
+
         self.logger = logging.getLogger(__name__)
         self.raw_exif = None
         self.exif = None
         self.date = None
+        self.duplicate_of = None
+        self.sprite = None
         self._get_metadata()
         #signals.media_initialized.send(self)
 
     def __repr__(self):
         return "<%s>(%r)" % (self.__class__.__name__, str(self))
 
+    def __getstate__(self):
+        # settings are attached again by Album.attach when loaded from the
+        # album tree cache, sprites are set again by the build
+        state = self.__dict__.copy()
+        for key in ('settings', 'logger', 'sprite'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(__name__)
+        self.sprite = None
+
     def __unicode__(self):
         return os.path.join(self.path, self.filename)
 
@@ -106,9 +135,15 @@ class Image(Media):
     type = 'image'
     extensions = ('.jpg', '.jpeg', '.png')
     
-    def __init__(self, filename, path, settings):
-        super(Image, self).__init__(filename, path, settings)
-        self.raw_exif, self.exif = get_exif_tags(self.src_path)
+    def __init__(self, filename, path, settings, metadata=None):
+        super(Image, self).__init__(filename, path, settings, metadata)
+        cached = metadata.get(self) if metadata is not None else None
+        if cached is None:
+            with instrument.stage('exif', self.relpath):
+                cached = get_exif_tags(self.src_path)
+            if metadata is not None:
+                metadata.set(self, cached)
+        self.raw_exif, self.exif = cached
         if self.exif is not None and 'dateobj' in self.exif:
             self.date = self.exif['dateobj']
 
@@ -119,8 +154,8 @@ class Video(Media):
     type = 'video'
     extensions = ('.mov', '.avi', '.mp4', '.webm', '.ogv')
 
-    def __init__(self, filename, path, settings):
-        super(Video, self).__init__(filename, path, settings)
+    def __init__(self, filename, path, settings, metadata=None):
+        super(Video, self).__init__(filename, path, settings, metadata)
         base = os.path.splitext(filename)[0]
         self.src_filename = filename
         self.filename = self.url = base + '.webm'
@@ -129,6 +164,22 @@ class Video(Media):
 
 # minimally modified from Sigal's gallery.Album class
 class Album(object):
+    """Album of the media of a source directory.
+
+    Besides its own media, an album indexed by
+    :meth:`~siglican.gallery.Gallery.index_albums` knows its place in the
+    tree:
+
+    - ``parent``: the album of the parent directory, or None.
+    - ``children``: the albums of the sub-directories, sorted.
+    - ``depth``: 0 for the source directory, 1 for its sub-directories, ...
+    - ``breadcrumb``: list of ``(url, title)`` tuples from the topmost
+        ancestor down to the album.
+    - ``total_medias``, ``total_medias_count`` and ``newest_date``: number
+        of media (by type) and most recent media date in the album and its
+        descendants.
+
+    """
     description_file = "index.md"
     output_file = 'index.html'
 
@@ -139,6 +190,10 @@ class Album(object):
         self.settings = settings
         self.orig_path = None
         self._thumbnail = None
+        self.depth = 0 if path == '.' else path.count(os.sep) + 1
+        self.parent = None
+        self.children = []
+        self.breadcrumb = []
 
         # set up source and destination paths
         if path == '.':
@@ -158,6 +213,8 @@ class Album(object):
         # creates appropriate subdirectory for the album
         self.index_url = url_from_path(os.path.relpath(
             settings['SIGLICAN_DESTINATION'], self.dst_path)) + '/' + self.url_ext
+        #: URL of the album, relative to its parent.
+        self.url = url_quote(self.name.encode('utf-8')) + '/' + self.url_ext
 
         # sort sub-albums
         dirnames.sort(key=strxfrm, reverse=settings['SIGLICAN_ALBUMS_SORT_REVERSE'])
@@ -169,12 +226,13 @@ class Album(object):
         self.medias_count = defaultdict(int)
         
         # create Media objects
+        metadata = getattr(gallery, 'metadata', None)
         for f in filenames:
             ext = os.path.splitext(f)[1]
             if ext.lower() in Image.extensions:
-                media = Image(f, self.path, settings)
+                media = Image(f, self.path, settings, metadata)
             elif ext.lower() in Video.extensions:
-                media = Video(f, self.path, settings)
+                media = Video(f, self.path, settings, metadata)
             else:
                 continue
 
@@ -206,6 +264,25 @@ class Album(object):
     def __len__(self):
         return len(self.medias)
 
+    def __getstate__(self):
+        # see attach()
+        state = self.__dict__.copy()
+        for key in ('gallery', 'settings', 'logger'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(__name__)
+
+    def attach(self, gallery, settings):
+        """Set the gallery and settings of an album (and of its media) loaded
+        from the album tree cache, which does not store them."""
+        self.gallery = gallery
+        self.settings = settings
+        for media in self.medias:
+            media.settings = settings
+
     def __iter__(self):
         return iter(self.medias)
 
@@ -228,21 +305,20 @@ class Album(object):
                 setattr(self, key, val)
 
     def create_output_directories(self):
-        """Create output directories for thumbnails and original images."""
-        
-        def check_or_create_dir(path):
-            if not os.path.isdir(path):
-                os.makedirs(path)
+        """Create output directories for thumbnails and original images.
+
+        The shards of a build create them concurrently, hence
+        :func:`~siglican.compat.makedirs`."""
 
-        check_or_create_dir(self.dst_path)
+        makedirs(self.dst_path)
 
         if self.medias:
-            check_or_create_dir(os.path.join(self.dst_path,
-                                     self.settings['SIGLICAN_THUMB_DIR']))
+            makedirs(os.path.join(self.dst_path,
+                                  self.settings['SIGLICAN_THUMB_DIR']))
 
-        #if self.medias and self.settings['SIGLICAN_KEEP_ORIG']:
-        #    self.orig_path = os.path.join(self.dst_path, self.settings['SIGLICAN_ORIG_DIR'])
-        #    check_or_create_dir(self.orig_path)
+        if self.medias and self.settings['SIGLICAN_KEEP_ORIG']:
+            self.orig_path = os.path.join(self.dst_path, self.settings['SIGLICAN_ORIG_DIR'])
+            makedirs(self.orig_path)
 
     @property
     def images(self):
@@ -263,15 +339,7 @@ class Album(object):
         """List of :class:`~sigal.gallery.Album` objects for each
         sub-directory.
         """
-        root_path = self.path if self.path != '.' else ''
-        return [self.gallery.albums[os.path.join(root_path, path)]
-                for path in self.subdirs]
-
-    @property
-    def url(self):
-        """URL of the album, relative to its parent."""
-        url = self.name.encode('utf-8')
-        return url_quote(url) + '/' + self.url_ext
+        return self.children
 
     @property
     def thumbnail(self):
@@ -291,10 +359,17 @@ class Album(object):
             return url_from_path(self._thumbnail)
         else:
             # find and return the first landscape image
+            from .image import (DECOMPRESSION_BOMB_ERRORS, ImageTooLargeError,
+                                open_image, pixel_limit)
+            limit = pixel_limit(self.settings)
             for f in self.medias:
                 ext = os.path.splitext(f.filename)[1]
                 if ext.lower() in Image.extensions:
-                    im = PILImage.open(f.src_path)
+                    try:
+                        im = open_image(f.src_path, limit)
+                    except (IOError, ImageTooLargeError) + \
+                            DECOMPRESSION_BOMB_ERRORS:
+                        continue
                     if im.size[0] > im.size[1]:
                         self._thumbnail = os.path.join(self.name, f.thumbnail)
                         self.logger.debug(
@@ -311,7 +386,7 @@ class Album(object):
 
             # use the thumbnail of their sub-directories
             if not self._thumbnail:
-                for path, album in self.gallery.get_albums(self.path):
+                for album in self.children:
                     if album.thumbnail:
                         self._thumbnail = os.path.join(self.name, album.thumbnail)
                         self.logger.debug(
@@ -323,56 +398,28 @@ class Album(object):
         return None
 
     @property
-    def breadcrumb(self):
-        """List of ``(url, title)`` tuples defining the current breadcrumb
-        path.
-        """
-        if self.path == '.':
-            return []
-
-        path = self.path
-        breadcrumb = [((self.url_ext or '.'), self.title)]
-
-        while True:
-            path = os.path.normpath(os.path.join(path, '..'))
-            if path == '.':
-                break
-
-            url = (url_from_path(os.path.relpath(path, self.path)) + '/' +
-                   self.url_ext)
-            breadcrumb.append((url, self.gallery.albums[path].title))
+    def cover(self):
+        """The media of this album whose thumbnail is :attr:`thumbnail`, or
+        None."""
+        thumbnail = self.thumbnail
+        for media in self.medias:
+            if url_from_path(os.path.join(self.name,
+                                          media.thumbnail)) == thumbnail:
+                return media
+        return None
 
-        breadcrumb.reverse()
-        return breadcrumb
-    
-    # TODO: delete this and related settings; this is not a use case that
-    # a Pelican plugin should handle
     @property
     def zip(self):
-        """Make a ZIP archive with all media files and return its path.
+        """Name of the album's ZIP archive, relative to the album directory.
 
-        If the ``zip_gallery`` setting is set,it contains the location of a zip
-        archive with all original images of the corresponding directory.
+        If the ``SIGLICAN_ZIP_GALLERY`` setting is set, the generator builds
+        an archive of the media of the album (see :mod:`siglican.archive`).
 
         """
         zip_gallery = self.settings['SIGLICAN_ZIP_GALLERY']
-
         if zip_gallery and len(self) > 0:
-            archive_path = os.path.join(self.dst_path, zip_gallery)
-            archive = zipfile.ZipFile(archive_path, 'w')
-
-            if self.settings['SIGLICAN_ZIP_MEDIA_FORMAT'] == 'orig':
-                for p in self:
-                    archive.write(p.src_path, os.path.split(p.src_path)[1])
-            else:
-                for p in self:
-                    archive.write(p.dst_path, os.path.split(p.dst_path)[1])
-
-            archive.close()
-            self.logger.debug('Created ZIP archive %s', archive_path)
             return zip_gallery
-        else:
-            return None
+        return None
 
 # ** TODO: move as part of utils cleanup
 def get_thumb(settings, filename):
@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Per-album ZIP archives. Archives are built by the generator after media
+# processing, off the page rendering path; templates only get their name.
+
+import hashlib
+import logging
+import os
+import zipfile
+
+from . import compat, utils
+
+# formats that are already compressed and gain nothing from deflate
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webm', '.mp4',
+                     '.mov', '.avi', '.ogv')
+
+_COMMENT_PREFIX = b'siglican:'
+
+
+def archive_members(album, settings):
+    """Return the ``(path, arcname)`` pairs that go into the album archive."""
+
+    members = []
+    seen = set()
+    use_orig = settings['SIGLICAN_ZIP_MEDIA_FORMAT'] == 'orig'
+    for media in album:
+        path = media.src_path if use_orig else media.dst_path
+        arcname = os.path.basename(path)
+        if arcname in seen:
+            continue
+        seen.add(arcname)
+        members.append((path, arcname))
+    return members
+
+
+def archive_signature(members):
+    """Digest of the names, sizes and mtimes of the archive members."""
+
+    h = hashlib.sha1()
+    for path, arcname in sorted(members, key=lambda m: m[1]):
+        st = os.stat(path)
+        h.update(('%s\0%d\0%d\n' % (arcname, st.st_size,
+                                    int(st.st_mtime))).encode('utf-8'))
+    return h.hexdigest().encode('ascii')
+
+
+def _read_signature(archive_path):
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            comment = archive.comment
+    except (IOError, OSError, zipfile.BadZipfile):
+        return None
+    if comment.startswith(_COMMENT_PREFIX):
+        return comment[len(_COMMENT_PREFIX):]
+    return None
+
+
+def write_archive(album, settings):
+    """Write the ZIP archive of ``album`` unless it is already up to date.
+
+    The archive is streamed to a temporary file next to its destination and
+    renamed into place, and its signature is kept in the archive comment.
+    Returns True if the archive was (re)written.
+    """
+
+    logger = logging.getLogger(__name__)
+    archive_path = os.path.join(album.dst_path,
+                                settings['SIGLICAN_ZIP_GALLERY'])
+
+    members = []
+    for path, arcname in archive_members(album, settings):
+        if os.path.isfile(path):
+            members.append((path, arcname))
+        else:
+            logger.warning('siglican: %s is missing from the archive of %r',
+                           path, album)
+    if not members:
+        return False
+
+    signature = archive_signature(members)
+    if _read_signature(archive_path) == signature:
+        logger.debug('siglican: ZIP archive %s is up to date', archive_path)
+        return False
+
+    tmp_path = os.path.join(album.dst_path,
+                            '.' + os.path.basename(archive_path) + '.tmp')
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', allowZip64=True) as archive:
+            for path, arcname in members:
+                ext = os.path.splitext(arcname)[1].lower()
+                compression = (zipfile.ZIP_STORED if ext in STORED_EXTENSIONS
+                               else zipfile.ZIP_DEFLATED)
+                archive.write(path, arcname, compression)
+            archive.comment = _COMMENT_PREFIX + signature
+        compat.replace(tmp_path, archive_path)
+        utils.changed_paths.add(os.path.abspath(archive_path))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.debug('siglican: created ZIP archive %s', archive_path)
+    return True
@@ -0,0 +1,232 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Bundles of the CSS and JavaScript files of a theme.
+
+With SIGLICAN_BUNDLE_ASSETS, the :class:`~siglican.writer.Writer` joins the
+stylesheets and the scripts of the theme into one file each, minifying the
+files whose name has no ``.min.``, and names the bundles after a hash of
+their content (``css/bundle.<hash>.css``), so that they can be cached
+forever. Templates find them in ``SIGLICAN_BUNDLES``.
+
+A theme lists the members of its bundles, in order, in ``bundles.json``::
+
+    {"css": ["css/style.min.css"],
+     "js": ["js/jquery-1.10.2.min.js", "js/jquery.colorbox.min.js"]}
+
+Without it, the bundles hold every ``.css`` and ``.js`` file of the static
+directory, jQuery first.
+"""
+
+import codecs
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+
+from . import compat
+from .utils import atomic_output
+
+logger = logging.getLogger(__name__)
+
+#: File of a theme listing the members of its bundles.
+BUNDLES_FILE = 'bundles.json'
+
+_FINGERPRINTED = re.compile(r'(^|/)bundle\.[0-9a-f]{12}\.(css|js)$')
+
+
+def is_fingerprinted(relpath):
+    """Whether ``relpath`` is the name of a bundle, whose content never
+    changes."""
+    return _FINGERPRINTED.search(relpath) is not None
+
+
+# strings, comments, whitespace, anything else
+_CSS_TOKEN = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+                        r'|(/\*.*?\*/)|(\s+)|([^"\'/\s]+|/)', re.S)
+_CSS_PUNCTUATION = '{};,>'
+
+
+def minify_css(text):
+    """Remove the comments (except ``/*! ... */``) and the needless
+    whitespace of a stylesheet."""
+    out = []
+    space = False
+    for m in _CSS_TOKEN.finditer(text):
+        string, comment, blank, other = m.groups()
+        if blank or (comment and not comment.startswith('/*!')):
+            space = True
+            continue
+        token = string or comment or other
+        if space and out and out[-1][-1] not in _CSS_PUNCTUATION and \
+                token[0] not in _CSS_PUNCTUATION:
+            out.append(' ')
+        space = False
+        if token == '}' and out and out[-1] == ';':
+            out.pop()
+        out.append(token)
+    return ''.join(out)
+
+
+_JS_TOKEN = re.compile(r'''("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|'''
+                       r'''`(?:\\.|[^`\\])*`)|(/\*.*?\*/|//[^\n]*)|(\s+)|'''
+                       r'([\w$]+)|(.)', re.S)
+# after these, a slash starts a regular expression rather than a division
+_JS_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+_JS_REGEX_KEYWORDS = set(['return', 'typeof', 'case', 'do', 'else', 'in',
+                          'instanceof', 'new', 'delete', 'void', 'throw'])
+_JS_REGEX = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[a-z]*')
+
+
+def minify_js(text):
+    """Remove the comments (except ``/*! ... */``) and the needless
+    whitespace of a script. Line breaks are kept (one for each run of
+    blank lines), so automatic semicolon insertion is unaffected."""
+    out = []
+    last = None  # last significant token
+    pending = None  # whitespace seen since it: None, ' ' or '\n'
+    pos = 0
+    while pos < len(text):
+        if text[pos] == '/' and text[pos + 1:pos + 2] not in ('/', '*') and \
+                (last is None or last in _JS_REGEX_AFTER or
+                 last in _JS_REGEX_KEYWORDS):
+            m = _JS_REGEX.match(text, pos)
+            if m is not None:
+                token = m.group(0)
+                pos = m.end()
+                pending = _js_separator(out, pending, token)
+                out.append(token)
+                last = token
+                continue
+        m = _JS_TOKEN.match(text, pos)
+        pos = m.end()
+        string, comment, blank, word, other = m.groups()
+        if blank or (comment and not comment.startswith('/*!')):
+            if '\n' in (blank or comment) or comment and \
+                    comment.startswith('//'):
+                pending = '\n'
+            elif pending is None:
+                pending = ' '
+            continue
+        token = string or comment or word or other
+        pending = _js_separator(out, pending, token)
+        out.append(token)
+        last = token
+    return ''.join(out)
+
+
+def _js_separator(out, pending, token):
+    """Append the whitespace needed between the output and ``token``."""
+    if pending is not None and out:
+        before, after = out[-1][-1], token[0]
+        if pending == '\n':
+            out.append('\n')
+        elif ((before.isalnum() or before in '_$') and
+              (after.isalnum() or after in '_$')) or \
+                (before == after and before in '+-'):
+            out.append(' ')
+    return None
+
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def _rebase_urls(css, member, bundle_dir):
+    """Make the relative URLs of ``css``, the content of the static file
+    ``member``, relative to ``bundle_dir``."""
+    def rebase(m):
+        url = m.group(2)
+        if re.match(r'[a-z]+:|/|#', url):
+            return m.group(0)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(member),
+                                                 url))
+        return 'url(%s)' % posixpath.relpath(path, bundle_dir)
+    return _CSS_URL.sub(rebase, css)
+
+
+def bundle_members(theme):
+    """Return the static files (relative paths) of ``theme`` that make up
+    its bundles, as a dict of lists keyed by ``'css'`` and ``'js'``."""
+    path = os.path.join(theme, BUNDLES_FILE)
+    if os.path.isfile(path):
+        with codecs.open(path, 'r', 'utf-8') as f:
+            members = json.load(f)
+        return dict((kind, members.get(kind, [])) for kind in ('css', 'js'))
+
+    static = os.path.join(theme, 'static')
+    members = {'css': [], 'js': []}
+    for dirpath, dirs, files in os.walk(static):
+        dirs.sort()
+        for f in sorted(files):
+            kind = os.path.splitext(f)[1][1:]
+            if kind in members:
+                relpath = os.path.relpath(os.path.join(dirpath, f), static)
+                members[kind].append(relpath.replace(os.sep, '/'))
+    members['js'].sort(
+        key=lambda r: not posixpath.basename(r).startswith('jquery'))
+    return members
+
+
+def build_bundles(theme):
+    """Return the bundles of ``theme`` as a dict of ``(relpath, content)``
+    keyed by ``'css'`` and ``'js'``, ``relpath`` being relative to the
+    static directory."""
+    static = os.path.join(theme, 'static')
+    bundles = {}
+    for kind, members in sorted(bundle_members(theme).items()):
+        if not members:
+            continue
+        parts = []
+        for member in members:
+            with codecs.open(os.path.join(static, *member.split('/')), 'r',
+                             'utf-8-sig') as f:
+                text = f.read()
+            if '.min.' not in posixpath.basename(member):
+                text = minify_css(text) if kind == 'css' else minify_js(text)
+            if kind == 'css':
+                text = _rebase_urls(text, member, kind)
+            parts.append(text.strip())
+        # a script may lack its final semicolon
+        content = ('\n' if kind == 'css' else ';\n').join(parts) + '\n'
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+        bundles[kind] = ('%s/bundle.%s.%s' % (kind, digest, kind), content)
+    return bundles
+
+
+def write_bundles(theme, static_dst):
+    """Write the bundles of ``theme`` below ``static_dst``, the static
+    directory of the output, and return their paths relative to it as a
+    dict keyed by ``'css'`` and ``'js'``."""
+    names = {}
+    for kind, (relpath, content) in build_bundles(theme).items():
+        path = os.path.join(static_dst, *relpath.split('/'))
+        names[kind] = relpath
+        if os.path.isfile(path):
+            continue  # same name, same content
+        compat.makedirs(os.path.dirname(path))
+        logger.debug("siglican: writing bundle %s", path)
+        with atomic_output(path) as tmp:
+            with codecs.open(tmp, 'w', 'utf-8') as f:
+                f.write(content)
+    return names
@@ -0,0 +1,373 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Reproducible benchmarks of the siglican build phases.
+
+Synthesizes a gallery of configurable shape, builds it with the generator
+outside of a full Pelican run and times the scan (``generate_context``),
+process and pages phases from the build report, cold (empty output and
+cache) and warm (incremental rebuild of an unchanged tree). Results are
+stored as JSON and can be compared with a previous run::
+
+    python -m siglican.benchmark --depth 2 --albums 3 --images 20 \
+        --output bench.json
+    python -m siglican.benchmark ... --baseline bench.json --threshold 0.1
+
+Videos are fake files processed by an ``ffmpeg`` stand-in, so the numbers
+measure siglican rather than the encoder.
+
+``--imports`` times the imports of the plugin instead, each in a fresh
+interpreter: what registering the plugin, creating the generator, starting a
+command line worker and entering the process and pages phases cost.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from .pkgmeta import __version__
+
+PHASES = ('generate_context', 'process', 'pages')
+
+#: Import scenarios: name, untimed setup and timed statement. Pelican is
+#: already loaded when it registers the plugin.
+IMPORTS = (
+    ('register', 'import pelican', 'import siglican; siglican.register()'),
+    ('generator', 'import pelican',
+     'import siglican; siglican.get_generators(None)'),
+    ('worker', '', 'import siglican.cli'),
+    ('process', 'import siglican.cli',
+     'import siglican.image, siglican.video'),
+    ('pages', 'import siglican.cli', 'import siglican.writer'),
+)
+
+_IMPORT_SCRIPT = '''
+import sys, time
+%(setup)s
+before = set(sys.modules)
+start = time.time()
+%(statement)s
+print(time.time() - start)
+print(len(set(sys.modules) - before))
+'''
+
+# answers ffmpeg's probe with a fixed size, dumps a JPEG frame for
+# thumbnails and copies the input for transcodes
+_FAKE_FFMPEG = '''#!%(python)s
+import shutil, sys
+args = sys.argv[1:]
+source = args[args.index('-i') + 1]
+if len(args) == 2:
+    sys.stderr.write('Stream #0:0: Video: h264, yuv420p, %(size)s\\n')
+    sys.exit(1)
+out = args[-1]
+if out.endswith('.jpg'):
+    from PIL import Image
+    Image.new('RGB', (%(width)d, %(height)d), (80, 120, 160)).save(out, 'JPEG')
+else:
+    shutil.copy(source, out)
+'''
+
+
+def _make_image(path, size, rng, exif):
+    from PIL import Image as PILImage
+    from PIL import ImageDraw
+
+    img = PILImage.new('RGB', size, tuple(rng.randint(0, 255)
+                                          for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x0, y0 = rng.randint(0, size[0]), rng.randint(0, size[1])
+        x1, y1 = x0 + rng.randint(1, size[0]), y0 + rng.randint(1, size[1])
+        draw.rectangle((x0, y0, x1, y1),
+                       fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    kwargs = {'quality': 90}
+    if exif:
+        tags = PILImage.Exif()
+        tags[0x0112] = 1                      # Orientation
+        tags[0x829D] = (28, 10)               # FNumber
+        tags[0x829A] = (1, 250)               # ExposureTime
+        tags[0x920A] = (35, 1)                # FocalLength
+        tags[0x8827] = 200                    # ISOSpeedRatings
+        tags[0x9003] = '2014:07:%02d 12:00:00' % rng.randint(1, 28)
+        kwargs['exif'] = tags.tobytes()
+    img.save(path, 'JPEG', **kwargs)
+
+
+def make_gallery(root, depth=1, albums=2, images=10, sizes=((1600, 1200),),
+                 exif=True, markdown=True, videos=0, video_bytes=1 << 20,
+                 seed=0):
+    """Write a synthetic source tree below ``root``.
+
+    Every album holds ``images`` JPEGs, cycling through ``sizes``, and
+    ``videos`` fake videos. Albums nest ``depth`` levels deep with ``albums``
+    sub-albums each. With ``markdown``, albums and every other image get a
+    description file. Returns the number of media written.
+    """
+    rng = random.Random(seed)
+    count = 0
+    todo = [(root, 0)]
+    while todo:
+        path, level = todo.pop()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if markdown:
+            with open(os.path.join(path, 'index.md'), 'w') as f:
+                f.write('Title: %s\n\nAlbum at depth %d.\n'
+                        % (os.path.basename(path), level))
+        for i in range(images):
+            name = 'img%04d.jpg' % i
+            _make_image(os.path.join(path, name), tuple(sizes[i % len(sizes)]),
+                        rng, exif)
+            if markdown and i % 2 == 0:
+                with open(os.path.join(path, 'img%04d.md' % i), 'w') as f:
+                    f.write('Title: Image %d\n\nA synthetic image.\n' % i)
+            count += 1
+        for i in range(videos):
+            with open(os.path.join(path, 'vid%04d.mp4' % i), 'wb') as f:
+                f.write(bytearray(rng.getrandbits(8)
+                                  for _ in range(min(video_bytes, 4096))))
+                f.seek(video_bytes - 1)
+                f.write(b'\0')
+            count += 1
+        if level < depth:
+            for i in range(albums):
+                todo.append((os.path.join(path, 'album%02d' % i), level + 1))
+    return count
+
+
+def install_fake_ffmpeg(bindir, size=(640, 480)):
+    """Put an ``ffmpeg`` stand-in in ``bindir`` and return its path."""
+    path = os.path.join(bindir, 'ffmpeg')
+    with open(path, 'w') as f:
+        f.write(_FAKE_FFMPEG % {'python': sys.executable,
+                                'size': '%dx%d' % size,
+                                'width': size[0], 'height': size[1]})
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+             stat.S_IXOTH)
+    return path
+
+
+def _site_settings(site, overrides):
+    from pelican.settings import read_settings
+
+    theme = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'examples', 'themes', 'colorbox')
+    dst_theme = os.path.join(site, 'siglican', 'colorbox')
+    if not os.path.isdir(dst_theme):
+        shutil.copytree(theme, dst_theme)
+    settings = read_settings(override={
+        'PATH': os.path.join(site, 'content'),
+        'OUTPUT_PATH': os.path.join(site, 'output'),
+        'CACHE_PATH': os.path.join(site, 'cache'),
+        'SITEURL': 'http://localhost',
+        'TIMEZONE': 'UTC',
+        'SIGLICAN_BUILD_REPORT': 'build-report.json',
+    })
+    settings.update(overrides)
+    return settings
+
+
+def run_build(site, overrides=None):
+    """Build the gallery of ``site`` once and return the phase timings."""
+    from .siglican import SigalGalleryGenerator
+
+    settings = _site_settings(site, overrides or {})
+    generator = SigalGalleryGenerator(
+        context=settings.copy(), settings=settings, path=settings['PATH'],
+        theme=settings['THEME'], output_path=settings['OUTPUT_PATH'])
+    start = time.time()
+    generator.generate_context()
+    generator.generate_output(None)
+    total = time.time() - start
+
+    with open(generator.settings['SIGLICAN_BUILD_REPORT']) as f:
+        report = json.load(f)
+    result = dict((phase, report['stages'].get(phase, {}).get('wall', 0.0))
+                  for phase in PHASES)
+    result['total'] = total
+    result['peak_rss'] = report['peak_rss']
+    return result
+
+
+def run(shape, repeat=3, overrides=None, workdir=None):
+    """Benchmark cold and warm builds of a gallery of ``shape`` (keyword
+    arguments of :func:`make_gallery`), keeping the best of ``repeat`` runs
+    of each phase."""
+    tmp = tempfile.mkdtemp(prefix='siglican-bench-', dir=workdir)
+    old_path = os.environ.get('PATH', '')
+    try:
+        site = os.path.join(tmp, 'site')
+        os.makedirs(os.path.join(site, 'content'))
+        media = make_gallery(os.path.join(site, 'siglican', 'images'),
+                             **shape)
+        bindir = os.path.join(tmp, 'bin')
+        os.makedirs(bindir)
+        install_fake_ffmpeg(bindir)
+        os.environ['PATH'] = bindir + os.pathsep + old_path
+
+        results = {'cold': [], 'warm': []}
+        for _ in range(repeat):
+            for d in ('output', 'cache'):
+                shutil.rmtree(os.path.join(site, d), ignore_errors=True)
+            results['cold'].append(run_build(site, overrides))
+            results['warm'].append(run_build(site, overrides))
+    finally:
+        os.environ['PATH'] = old_path
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    best = {}
+    for mode, runs in results.items():
+        best[mode] = dict((k, min(r[k] for r in runs)) for k in runs[0]
+                          if k != 'peak_rss')
+        best[mode]['peak_rss'] = max(r['peak_rss'] or 0 for r in runs)
+    return {
+        'siglican': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'shape': shape,
+        'media': media,
+        'repeat': repeat,
+        'results': best,
+    }
+
+
+def time_imports(repeat=5):
+    """Time the :data:`IMPORTS` scenarios in fresh interpreters, keeping the
+    best of ``repeat`` runs, and count the modules each one loads."""
+    plugins = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best, modules = {}, {}
+    for name, setup, statement in IMPORTS:
+        script = _IMPORT_SCRIPT % {'setup': setup, 'statement': statement}
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', script],
+                                             cwd=plugins)
+            elapsed, count = output.decode('ascii').split()
+            best[name] = min(best.get(name, float('inf')), float(elapsed))
+            modules[name] = int(count)
+    return {
+        'siglican': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'repeat': repeat,
+        'results': {'imports': best},
+        'modules': modules,
+    }
+
+
+def compare(current, baseline, threshold=0.1):
+    """Return the ``(mode, phase, baseline, current)`` timings of ``current``
+    that are more than ``threshold`` (a fraction) slower than ``baseline``."""
+    regressions = []
+    for mode, phases in current['results'].items():
+        for phase, value in phases.items():
+            if phase == 'peak_rss':
+                continue
+            base = baseline['results'].get(mode, {}).get(phase)
+            # ignore phases too short to be measured reliably
+            if base is None or max(base, value) < 0.05:
+                continue
+            if value > base * (1 + threshold):
+                regressions.append((mode, phase, base, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m siglican.benchmark',
+        description='Benchmark siglican on a synthetic gallery.')
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--albums', type=int, default=2,
+                        help='sub-albums per album')
+    parser.add_argument('--images', type=int, default=10,
+                        help='images per album')
+    parser.add_argument('--size', action='append', default=[],
+                        metavar='WxH', help='image size, may be repeated')
+    parser.add_argument('--no-exif', dest='exif', action='store_false')
+    parser.add_argument('--no-markdown', dest='markdown', action='store_false')
+    parser.add_argument('--videos', type=int, default=0,
+                        help='fake videos per album')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=JSON', help='override a setting')
+    parser.add_argument('--imports', action='store_true',
+                        help='time the imports instead of a build')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    sizes = [tuple(int(v) for v in s.split('x')) for s in args.size]
+    shape = {'depth': args.depth, 'albums': args.albums,
+             'images': args.images, 'sizes': sizes or [(1600, 1200)],
+             'exif': args.exif, 'markdown': args.markdown,
+             'videos': args.videos, 'seed': args.seed}
+    overrides = dict((k, json.loads(v)) for k, v in
+                     (s.split('=', 1) for s in args.set))
+
+    if args.imports:
+        results = time_imports(repeat=max(args.repeat, 5))
+        for name, _, _ in IMPORTS:
+            print('import %-9s %.3fs  %4d modules' % (
+                name, results['results']['imports'][name],
+                results['modules'][name]))
+    else:
+        results = run(shape, repeat=args.repeat, overrides=overrides)
+        for mode in ('cold', 'warm'):
+            print('%-5s %s' % (mode, '  '.join(
+                '%s=%.3fs' % (phase, results['results'][mode][phase])
+                for phase in PHASES + ('total',))))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for mode, phase, base, value in regressions:
+            print('REGRESSION %s %s: %.3fs -> %.3fs (+%.0f%%)'
+                  % (mode, phase, base, value, 100 * (value / base - 1)))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,657 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Small persistent stores kept in SIGLICAN_CACHE_PATH between builds.
+
+import codecs
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import threading
+
+from . import compat
+from .pkgmeta import __version__
+from .utils import file_digest, place_file
+
+logger = logging.getLogger(__name__)
+
+
+def source_stamp(path):
+    """Return a ``[size, mtime]`` stamp of ``path`` that changes whenever the
+    file is modified, or None if it can't be read."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def _load_json(path, default):
+    if not os.path.isfile(path):
+        return default
+    try:
+        with codecs.open(path, 'r', 'utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("siglican: ignoring unreadable cache file %s: %s",
+                       path, e)
+        return default
+
+
+def _save_json(path, data):
+    dirname = os.path.dirname(path)
+    if dirname:
+        compat.makedirs(dirname)
+    tmp_path = path + '.tmp'
+    with codecs.open(tmp_path, 'w', 'utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    compat.replace(tmp_path, path)
+
+
+class Quarantine(object):
+    """Media that failed to process, skipped until their source changes.
+
+    Entries are keyed by the media path relative to ``SIGLICAN_SOURCE`` and
+    hold the stamp of the source at the time of the failure.
+    """
+
+    filename = 'quarantine.json'
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, self.filename)
+        self.entries = _load_json(self.path, {})
+        self.added = []
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, media):
+        entry = self.entries.get(media.relpath)
+        return (entry is not None and
+                entry['stamp'] == source_stamp(media.src_path))
+
+    def add(self, media):
+        self.entries[media.relpath] = {'type': media.type,
+                                       'stamp': source_stamp(media.src_path)}
+        self.added.append(media.relpath)
+        self._dirty = True
+
+    def discard(self, media):
+        if self.entries.pop(media.relpath, None) is not None:
+            self._dirty = True
+
+    def merge(self, entries):
+        """Add the ``entries`` of another quarantine (of a shard build)."""
+        if entries:
+            self.entries.update(entries)
+            self._dirty = True
+
+    def prune(self, relpaths):
+        """Forget the entries whose media are not in ``relpaths`` anymore."""
+        for key in set(self.entries) - set(relpaths):
+            del self.entries[key]
+            self._dirty = True
+
+    def save(self):
+        if self._dirty:
+            _save_json(self.path, self.entries)
+            self._dirty = False
+
+
+class Backlog(object):
+    """Media left unprocessed by a build that ran out of its time or job
+    budget, in the order they were to be processed, so that the next build
+    starts with them."""
+
+    filename = 'backlog.json'
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, self.filename)
+        self.entries = _load_json(self.path, [])
+        self._positions = dict((relpath, i)
+                               for i, relpath in enumerate(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def position(self, media):
+        """Rank of ``media`` in the backlog; media not in it come last."""
+        return self._positions.get(media.relpath, len(self.entries))
+
+    def update(self, considered, deferred, keep):
+        """Replace the entries of the ``considered`` media by the
+        ``deferred`` ones and drop those not in ``keep``, then save."""
+        considered = set(considered)
+        keep = set(keep)
+        entries = [relpath for relpath in self.entries
+                   if relpath not in considered and relpath in keep]
+        entries.extend(deferred)
+        if entries == self.entries:
+            return
+        self.entries = entries
+        if entries:
+            _save_json(self.path, entries)
+        elif os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class ChangeSet(object):
+    """Output files, as paths relative to SIGLICAN_DESTINATION, written or
+    removed since they were last published, and the target they were last
+    published to."""
+
+    filename = 'changes.json'
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, self.filename)
+        data = _load_json(self.path, {})
+        self.target = data.get('target')
+        self.pending = set(data.get('pending', []))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, relpaths):
+        self.pending.update(relpaths)
+
+    def published(self, target, failed=()):
+        """Record a publish to ``target`` that left only ``failed``."""
+        self.target = target
+        self.pending = set(failed)
+
+    def save(self):
+        _save_json(self.path, {'target': self.target,
+                               'pending': sorted(self.pending)})
+
+
+class OutputManifest(object):
+    """Every file below SIGLICAN_DESTINATION, as a path relative to it,
+    once a walk of the destination created the manifest; builds keep it up
+    to date from the files they write and remove. ``entries`` is None until
+    then."""
+
+    filename = 'manifest.json'
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, self.filename)
+        entries = _load_json(self.path, None)
+        self.entries = set(entries) if entries is not None else None
+
+    def update(self, relpaths, destination):
+        """Add the ``relpaths`` that exist below ``destination`` and drop
+        the others."""
+        for relpath in relpaths:
+            if os.path.isfile(os.path.join(destination, *relpath.split('/'))):
+                self.entries.add(relpath)
+            else:
+                self.entries.discard(relpath)
+
+    def save(self):
+        _save_json(self.path, sorted(self.entries))
+
+
+class SpriteIndex(object):
+    """Layout of the thumbnail sprite sheets of each album (see
+    :mod:`siglican.sprites`), keyed by the album path: the signature of the
+    thumbnails they were made from, the sheets, relative to the album
+    directory, and the ``[sheet, x, y, width, height]`` of each media."""
+
+    filename = 'sprites.json'
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, self.filename)
+        self.entries = _load_json(self.path, {})
+        self._dirty = False
+
+    def get(self, album_path):
+        return self.entries.get(album_path)
+
+    def set(self, album_path, entry):
+        self.entries[album_path] = entry
+        self._dirty = True
+
+    def discard(self, album_path):
+        if self.entries.pop(album_path, None) is not None:
+            self._dirty = True
+
+    def prune(self, album_paths):
+        """Forget the albums that are not in ``album_paths`` anymore."""
+        for key in set(self.entries) - set(album_paths):
+            del self.entries[key]
+            self._dirty = True
+
+    def save(self):
+        if self._dirty:
+            _save_json(self.path, self.entries)
+            self._dirty = False
+
+
+class BuildJournal(object):
+    """Append-only record of the media whose derivatives are all written.
+
+    Each line holds the media path relative to ``SIGLICAN_SOURCE`` and the
+    stamp of the source it was built from, and is flushed as soon as the
+    media is done, so a build that is killed can resume where it stopped.
+    The journal is compacted at the end of every complete build. It only
+    applies to the destination and the names of outputs (``settings``) it
+    was written for.
+    """
+
+    filename = 'journal'
+
+    #: Settings that name the outputs of a media.
+    layout_settings = ('SIGLICAN_MAKE_THUMBS', 'SIGLICAN_THUMB_DIR',
+                       'SIGLICAN_THUMB_PREFIX', 'SIGLICAN_THUMB_SUFFIX')
+
+    def __init__(self, cache_path, destination, settings):
+        self.path = os.path.join(cache_path, self.filename)
+        self.destination = os.path.abspath(destination)
+        self.layout = [settings[k] for k in self.layout_settings]
+        self.entries = {}
+        self._file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with codecs.open(self.path, 'r', 'utf-8') as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return
+        if header.get('destination') != self.destination or \
+                header.get('layout') != self.layout:
+            # the outputs moved or were renamed; nothing recorded applies
+            return
+        for line in lines[1:]:
+            try:
+                relpath, stamp = json.loads(line)
+            except ValueError:
+                # a line cut short when the previous build was killed
+                continue
+            self.entries[relpath] = stamp
+
+    def status(self, media):
+        """Return True if ``media`` was completed from its current source,
+        False if it was completed from an older version of it and None if it
+        is unknown."""
+        stamp = self.entries.get(media.relpath)
+        if stamp is None:
+            return None
+        return stamp == source_stamp(media.src_path)
+
+    def merge(self, entries):
+        """Add the ``entries`` of another journal (of a shard build), which
+        are written by :meth:`close`."""
+        self.entries.update(entries)
+
+    def record(self, media):
+        stamp = source_stamp(media.src_path)
+        self.entries[media.relpath] = stamp
+        if self._file is None:
+            self._rewrite()
+            self._file = codecs.open(self.path, 'a', 'utf-8')
+        self._file.write(json.dumps([media.relpath, stamp]) + '\n')
+        self._file.flush()
+
+    def _rewrite(self, keep=None):
+        if keep is not None:
+            self.entries = dict((k, v) for k, v in self.entries.items()
+                                if k in keep)
+        lines = [json.dumps({'destination': self.destination,
+                             'layout': self.layout})]
+        lines.extend(json.dumps([k, v]) for k, v in sorted(self.entries.items()))
+        dirname = os.path.dirname(self.path)
+        compat.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        with codecs.open(tmp_path, 'w', 'utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        compat.replace(tmp_path, self.path)
+
+    def close(self, keep=None):
+        """Compact the journal, keeping only the media in ``keep``."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._rewrite(keep)
+
+
+class MetadataCache(object):
+    """Metadata read from the media files (EXIF), keyed by media path and
+    invalidated when the source stamp changes.
+
+    Filled while scanning, so a scan by the command line interface can be
+    reused by the Pelican generator.
+    """
+
+    filename = 'metadata.pickle'
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, self.filename)
+        self.entries = {}
+        self._dirty = False
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    self.entries = pickle.load(f)
+            except Exception as e:
+                logger.warning("siglican: ignoring unreadable cache file "
+                               "%s: %s", self.path, e)
+
+    def get(self, media):
+        """Return the cached metadata of ``media`` or None."""
+        entry = self.entries.get(media.relpath)
+        if entry is not None and entry[0] == source_stamp(media.src_path):
+            return entry[1]
+        return None
+
+    def set(self, media, value):
+        self.entries[media.relpath] = (source_stamp(media.src_path), value)
+        self._dirty = True
+
+    def get_extra(self, media, key):
+        """Return the value stored with :meth:`set_extra` for the current
+        source of ``media``, or None."""
+        entry = self.entries.get(media.relpath)
+        if entry is None or len(entry) < 3 or \
+                entry[0] != source_stamp(media.src_path):
+            return None
+        return entry[2].get(key)
+
+    def set_extra(self, media, key, value):
+        """Store ``value`` with the metadata of ``media``, if it has current
+        metadata: it is dropped with them when the source changes."""
+        entry = self.entries.get(media.relpath)
+        if entry is None or entry[0] != source_stamp(media.src_path):
+            return
+        extra = dict(entry[2]) if len(entry) > 2 else {}
+        extra[key] = value
+        self.entries[media.relpath] = (entry[0], entry[1], extra)
+        self._dirty = True
+
+    def merge(self, entries):
+        """Add the ``entries`` of another cache (of a shard build)."""
+        if entries:
+            self.entries.update(entries)
+            self._dirty = True
+
+    def save(self, keep=None):
+        """Write the cache, keeping only the media in ``keep``."""
+        if keep is not None:
+            for key in set(self.entries) - set(keep):
+                del self.entries[key]
+                self._dirty = True
+        if not self._dirty:
+            return
+        dirname = os.path.dirname(self.path)
+        compat.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.warning("siglican: could not write %s: %s", self.path, e)
+            os.remove(tmp_path)
+            return
+        compat.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def directory_snapshot(path, files):
+    """Return a snapshot of directory ``path`` and of its ``files``, which
+    changes whenever an entry is added, removed or modified."""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    return (mtime, tuple(sorted((f, tuple(source_stamp(os.path.join(path, f))
+                                          or ()))
+                                for f in files)))
+
+
+#: Settings that do not change how albums are scanned.
+_VOLATILE_SETTINGS = ('SIGLICAN_BUILD_REPORT', 'SIGLICAN_BUILD_REPORT_SLOWEST',
+                      'SIGLICAN_PROFILE', 'SIGLICAN_TRACE',
+                      'SIGLICAN_PROCESS_MEDIA', 'SIGLICAN_WRITE_HTML',
+                      'SIGLICAN_MAX_IMAGE_PIXELS', 'SIGLICAN_MEMORY_BUDGET',
+                      'SIGLICAN_WORKERS',
+                      'SIGLICAN_PREFETCH_DEPTH', 'SIGLICAN_PREFETCH_MEMORY',
+                      'SIGLICAN_SHARED_CACHE', 'SIGLICAN_SHARED_CACHE_SIZE',
+                      'SIGLICAN_JPG_QUALITY_RANGE',
+                      'SIGLICAN_JPG_QUALITY_TRIALS',
+                      'SIGLICAN_JPG_TARGET_SSIM',
+                      'SIGLICAN_JOB_BUDGET', 'SIGLICAN_TIME_BUDGET',
+                      'SIGLICAN_SHARD', 'SIGLICAN_PRUNE', 'SIGLICAN_PUBLISH',
+                      'SIGLICAN_PUBLISH_CACHE_CONTROL',
+                      'SIGLICAN_PUBLISH_ENDPOINT', 'SIGLICAN_PUBLISH_WORKERS',
+                      'SIGLICAN_BUNDLE_ASSETS', 'SIGLICAN_THUMB_SPRITES',
+                      'SIGLICAN_THUMB_SPRITE_COUNT')
+
+
+class AlbumTreeCache(object):
+    """The albums of a previous scan with a snapshot of their directories.
+
+    A directory whose snapshot is unchanged, and whose sub-directories are all
+    unchanged, gets its album from the cache instead of reading its files
+    again. Like Pelican's content cache, it is only loaded with
+    ``LOAD_CONTENT_CACHE`` and written with ``CACHE_CONTENT``, compressed
+    with ``GZIP_CACHE``. The cache is discarded when its version or any
+    siglican setting differs.
+    """
+
+    filename = 'albums.pickle'
+    #: Bump when the pickled classes change incompatibly.
+    version = 2
+
+    def __init__(self, cache_path, settings):
+        self.path = os.path.join(cache_path, self.filename)
+        self.key = sorted((k, repr(v)) for k, v in settings.items()
+                          if k.startswith('SIGLICAN_') and
+                          k not in _VOLATILE_SETTINGS)
+        self.enabled = bool(settings.get('CACHE_CONTENT'))
+        if settings.get('GZIP_CACHE', True):
+            import gzip
+            self._open = gzip.open
+        else:
+            self._open = open
+        self.snapshots = {}
+        self.albums = {}
+        # whether a cache matching the settings was read
+        self.loaded = False
+        if settings.get('LOAD_CONTENT_CACHE'):
+            self._load()
+
+    def _load(self):
+        try:
+            with self._open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, OSError, EOFError) as e:
+            logger.debug("siglican: cannot load %s (normal on the first "
+                         "run): %s", self.path, e)
+            return
+        except Exception as e:
+            logger.warning("siglican: ignoring unreadable cache file %s: %s",
+                           self.path, e)
+            return
+        if data.get('version') != self.version or data.get('key') != self.key:
+            logger.info("siglican: album cache is out of date, rescanning")
+            return
+        self.snapshots = data['snapshots']
+        self.albums = data['albums']
+        self.loaded = True
+
+    def get(self, relpath, snapshot):
+        """Return ``(True, album)`` if the directory ``relpath`` is unchanged
+        since it was cached (``album`` is None for directories without an
+        album), or ``(False, None)``."""
+        if snapshot is None or self.snapshots.get(relpath) != snapshot:
+            return False, None
+        return True, self.albums.get(relpath)
+
+    def save(self, snapshots, albums):
+        """Write ``albums`` and the ``snapshots`` of the directories they were
+        scanned from, if content caching is enabled."""
+        if not self.enabled:
+            return
+        dirname = os.path.dirname(self.path)
+        compat.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        data = {'version': self.version, 'key': self.key,
+                'snapshots': snapshots, 'albums': albums}
+        try:
+            with self._open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.warning("siglican: could not write %s: %s", self.path, e)
+            os.remove(tmp_path)
+            return
+        compat.replace(tmp_path, self.path)
+
+
+class DerivativeCache(object):
+    """Resized media and thumbnails shared between sites and builds.
+
+    Entries are keyed by the content of the source, the settings that shape
+    the derivatives and the siglican version, so any gallery with the same
+    media and settings can reuse them. Each entry is a directory of
+    SIGLICAN_SHARED_CACHE holding the resized media and the thumbnail;
+    derivatives are placed from it, and into it, with the
+    SIGLICAN_FILE_PLACEMENT strategies (hard links where possible). The
+    mtime of an entry records its last use, and :meth:`evict` removes the
+    least recently used entries beyond SIGLICAN_SHARED_CACHE_SIZE bytes.
+    """
+
+    #: Settings that change the content of the derivatives.
+    key_settings = ('SIGLICAN_AUTOROTATE_IMAGES', 'SIGLICAN_COPY_EXIF_DATA',
+                    'SIGLICAN_IMG_PROCESSOR', 'SIGLICAN_IMG_SIZE',
+                    'SIGLICAN_JPG_OPTIONS', 'SIGLICAN_JPG_QUALITY_RANGE',
+                    'SIGLICAN_JPG_QUALITY_TRIALS', 'SIGLICAN_JPG_TARGET_SSIM',
+                    'SIGLICAN_MAKE_THUMBS',
+                    'SIGLICAN_THUMB_FIT', 'SIGLICAN_THUMB_SIZE',
+                    'SIGLICAN_VIDEO_SIZE', 'SIGLICAN_WEBM_OPTIONS')
+
+    def __init__(self, path, settings):
+        self.path = os.path.abspath(path)
+        self.max_bytes = settings['SIGLICAN_SHARED_CACHE_SIZE']
+        self.make_thumbs = settings['SIGLICAN_MAKE_THUMBS']
+        # a symlink would break when its entry is evicted
+        self.strategies = [s for s in settings['SIGLICAN_FILE_PLACEMENT']
+                           if s != 'symlink']
+        self.salt = repr((__version__, sorted(
+            (k, settings[k]) for k in self.key_settings)))
+
+    def key(self, media):
+        """Return the key of the derivatives of ``media``."""
+        h = hashlib.sha1(self.salt.encode('utf-8'))
+        h.update(repr((media.type,
+                       os.path.splitext(media.dst_path)[1].lower(),
+                       file_digest(media.src_path))).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _outputs(self, media):
+        outputs = [('resized' + os.path.splitext(media.dst_path)[1],
+                    media.dst_path)]
+        if self.make_thumbs:
+            outputs.append(('thumb' + os.path.splitext(media.thumb_path)[1],
+                            media.thumb_path))
+        return outputs
+
+    def fetch(self, media, key):
+        """Place the derivatives of ``media`` from the entry ``key``. Returns
+        False if there is no such entry."""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            for name, dst in self._outputs(media):
+                place_file(os.path.join(entry, name), dst, self.strategies)
+            os.utime(entry, None)
+        except (IOError, OSError) as e:
+            # evicted meanwhile by another build
+            logger.debug("siglican: cannot use shared cache entry %s: %s",
+                         entry, e)
+            return False
+        return True
+
+    def store(self, media, key):
+        """Add the derivatives of ``media`` as the entry ``key``. Returns
+        True if it was added."""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return False
+        # builds sharing the cache may store the same entry at once
+        tmp = '%s.%d-%d.tmp' % (entry, os.getpid(),
+                                threading.current_thread().ident)
+        try:
+            os.makedirs(tmp)
+            for name, src in self._outputs(media):
+                place_file(src, os.path.join(tmp, name), self.strategies)
+            os.rename(tmp, entry)
+        except (IOError, OSError) as e:
+            logger.debug("siglican: cannot store %s in the shared cache: %s",
+                         media.relpath, e)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        return True
+
+    def evict(self):
+        """Remove the least recently used entries until the cache holds at
+        most ``max_bytes``. Returns the number of entries removed."""
+        if not self.max_bytes or not os.path.isdir(self.path):
+            return 0
+        entries, total = [], 0
+        for prefix in os.listdir(self.path):
+            top = os.path.join(self.path, prefix)
+            if not os.path.isdir(top):
+                continue
+            for name in os.listdir(top):
+                entry = os.path.join(top, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, f))
+                               for f in os.listdir(entry))
+                    entries.append((os.stat(entry).st_mtime, size, entry))
+                except OSError:
+                    continue
+                total += size
+        removed = 0
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(entry))
+            except OSError:
+                pass  # other entries share the prefix
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,337 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Command line interface to process a gallery outside of a Pelican build.
+
+The media of the source tree are scanned and processed with the same code
+and settings as the Pelican generator, so that a Pelican build with
+``SIGLICAN_PROCESS_MEDIA = False`` only has to read the metadata cache and
+write the album pages::
+
+    python -m siglican build -s pelicanconf.py
+    python -m siglican build --source photos/ --destination output/gallery
+
+``watch`` builds once and then keeps the gallery up to date as files change
+below the source and theme directories, rescanning and processing only the
+affected albums::
+
+    python -m siglican watch -s pelicanconf.py
+
+``serve`` writes the album pages right away and serves the output over HTTP,
+creating each resized media or thumbnail when it is first requested::
+
+    python -m siglican serve -s pelicanconf.py --port 8000
+
+``prune`` removes the resized media, thumbnails, pages and other outputs
+that the current albums and theme no longer produce::
+
+    python -m siglican prune -s pelicanconf.py --dry-run
+
+``publish`` sends the output files that builds changed since the last
+publish to a directory or an S3 bucket (SIGLICAN_PUBLISH)::
+
+    python -m siglican publish -s pelicanconf.py --target s3://bucket/gallery
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from . import compat
+from .gallery import clean_settings, find_theme, Gallery, get_settings, \
+    resolve_pelican_paths
+
+logger = logging.getLogger(__name__)
+
+
+def load_settings(args):
+    """Return the cleaned settings for the command line ``args``.
+
+    Settings are read from the Pelican configuration file, if any, so that
+    paths resolve exactly as in the generator; ``--source``,
+    ``--destination``, ``--cache`` and ``--set`` override them.
+    """
+    settings = {}
+    if args.settings:
+        from pelican.settings import read_settings
+        settings = get_settings(read_settings(args.settings))
+        # relative defaults are relative to where pelican runs, which is
+        # usually next to its configuration file
+        basedir = os.path.dirname(os.path.abspath(args.settings))
+        for key in ('OUTPUT_PATH', 'CACHE_PATH'):
+            if key in settings and not os.path.isabs(settings[key]):
+                settings[key] = os.path.join(basedir, settings[key])
+        resolve_pelican_paths(settings)
+    settings = get_settings(settings)
+    for kv in args.set:
+        key, value = kv.split('=', 1)
+        settings[key] = json.loads(value)
+    if args.source:
+        settings['SIGLICAN_SOURCE'] = os.path.abspath(args.source)
+    if args.destination:
+        settings['SIGLICAN_DESTINATION'] = os.path.abspath(args.destination)
+    if args.cache:
+        settings['SIGLICAN_CACHE_PATH'] = os.path.abspath(args.cache)
+    if getattr(args, 'shard', None):
+        settings['SIGLICAN_SHARD'] = args.shard
+    if not args.settings and not (args.source and args.destination):
+        raise SystemExit('siglican: either --settings or both --source and '
+                         '--destination are required')
+    return clean_settings(settings)
+
+
+def build(settings, context=None, merge=False):
+    """Scan the source tree and process its media, and write the album pages
+    if a template ``context`` is given. With ``merge``, the results of shard
+    builds are merged first. Returns the gallery."""
+    gallery = Gallery(settings)
+    if merge:
+        logger.info("siglican: merged %d shards", gallery.merge_shards())
+    gallery.scan()
+    compat.makedirs(settings['SIGLICAN_DESTINATION'])
+    gallery.process()
+    archiver = gallery.start_archives()
+    if context is not None:
+        gallery.update_context(context)
+        gallery.write_pages(context)
+    if archiver is not None:
+        archiver.join()
+    gallery.save_tree()
+    # shards prune and publish once merged
+    if settings['SIGLICAN_PRUNE'] and settings['SIGLICAN_SHARD'] is None:
+        gallery.prune(dry_run=settings['SIGLICAN_PRUNE'] == 'report')
+    gallery.save_changes()
+    if settings['SIGLICAN_PUBLISH'] and settings['SIGLICAN_SHARD'] is None:
+        gallery.publish()
+    gallery.log_summary()
+    gallery.write_report()
+    return gallery
+
+
+def page_context(settings):
+    """Template context for the album pages, or None if they cannot be
+    written: that needs the Pelican theme and output path of ``-s``.
+
+    Unlike in a Pelican build, the context only holds the settings, not what
+    other generators add to it (articles, pages, categories).
+    """
+    if 'THEME' not in settings or not settings['SIGLICAN_WRITE_HTML']:
+        return None
+    return dict(settings)
+
+
+def watch(settings, interval=1.0):
+    """Build, then update the gallery whenever its source or theme changes,
+    until interrupted."""
+    context = page_context(settings)
+    gallery = build(settings, context)
+    source = settings['SIGLICAN_SOURCE']
+    themes = []
+    if context is not None:
+        themes = [find_theme(settings),
+                  os.path.join(settings['THEME'], 'templates')]
+    from .watch import watch as watch_paths
+    watcher = watch_paths([source] + [t for t in themes if os.path.isdir(t)],
+                          interval)
+    logger.warning("siglican: watching %s for changes, press Ctrl-C to stop",
+                   ', '.join(watcher.roots))
+    try:
+        while True:
+            changed = watcher.wait()
+            started = time.time()
+            in_theme = [p for p in changed
+                        if any(p.startswith(t + os.sep) for t in themes)]
+            albums = gallery.update(set(changed) - set(in_theme))
+            archiver = gallery.start_archives(
+                [gallery.albums[p] for p in albums])
+            if context is not None and (albums or in_theme):
+                gallery.update_context(context)
+                # templates or static files changed: write every page
+                gallery.write_pages(context, None if in_theme else albums)
+            if archiver is not None:
+                archiver.join()
+            if settings['SIGLICAN_PRUNE']:
+                gallery.prune(dry_run=settings['SIGLICAN_PRUNE'] == 'report')
+            gallery.save_changes()
+            if settings['SIGLICAN_PUBLISH']:
+                gallery.publish()
+            logger.warning("siglican: updated %d albums in %.2fs",
+                           len(gallery.albums) if in_theme else len(albums),
+                           time.time() - started)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return gallery
+
+
+def prune(settings, dry_run=False):
+    """Remove the output files that the albums and theme no longer
+    produce, without building."""
+    gallery = Gallery(settings)
+    gallery.scan()
+    gallery.prune(dry_run)
+    gallery.log_summary()
+    return gallery
+
+
+def publish(settings, target=None, dry_run=False):
+    """Send the output files changed since the last publish to ``target``,
+    by default SIGLICAN_PUBLISH, without building."""
+    target = target or settings['SIGLICAN_PUBLISH']
+    if not target:
+        raise SystemExit('siglican: nowhere to publish to, set '
+                         'SIGLICAN_PUBLISH or use --target')
+    gallery = Gallery(settings)
+    gallery.publish(target, dry_run)
+    gallery.log_summary()
+    return gallery
+
+
+def serve(settings, bind='127.0.0.1', port=8000):
+    """Write the album pages without processing any media, then serve the
+    output and create the derivatives as they are requested."""
+    gallery = Gallery(settings)
+    gallery.scan()
+    for album in gallery.albums.values():
+        album.create_output_directories()
+    context = page_context(settings)
+    if context is not None:
+        gallery.update_context(context)
+        gallery.write_pages(context)
+        root = settings['OUTPUT_PATH']
+    else:
+        root = settings['SIGLICAN_DESTINATION']
+    from .server import serve as serve_http
+    serve_http(gallery, root, bind, port)
+    gallery.log_summary()
+    return gallery
+
+
+def _add_common_arguments(parser):
+    parser.add_argument('-s', '--settings',
+                        help='Pelican configuration file to read the '
+                        'SIGLICAN_ settings and paths from')
+    parser.add_argument('--source', help='directory of albums (overrides '
+                        'SIGLICAN_SOURCE)')
+    parser.add_argument('--destination', help='output directory of the '
+                        'gallery (overrides SIGLICAN_DESTINATION)')
+    parser.add_argument('--cache', help='cache directory (overrides '
+                        'SIGLICAN_CACHE_PATH)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=JSON', help='override a setting, e.g. '
+                        'SIGLICAN_IMG_SIZE=[1024,768]')
+    parser.add_argument('-v', '--verbose', action='store_const',
+                        dest='loglevel', const=logging.INFO,
+                        default=logging.WARNING)
+    parser.add_argument('-d', '--debug', action='store_const',
+                        dest='loglevel', const=logging.DEBUG)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m siglican',
+                                     description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    build_parser = commands.add_parser(
+        'build', help='scan the source tree and process its media')
+    _add_common_arguments(build_parser)
+    build_parser.add_argument('--shard', metavar='I/N',
+                              help='only process the media of shard I of N '
+                              '(sets SIGLICAN_SHARD)')
+
+    merge_parser = commands.add_parser(
+        'merge', help='merge shard builds and write the album pages')
+    _add_common_arguments(merge_parser)
+
+    watch_parser = commands.add_parser(
+        'watch', help='build, then update the gallery as its files change')
+    _add_common_arguments(watch_parser)
+    watch_parser.add_argument('--interval', type=float, default=1.0,
+                              help='seconds between scans where inotify is '
+                              'unavailable (default: 1)')
+
+    serve_parser = commands.add_parser(
+        'serve', help='write the pages and serve them, creating resized '
+        'media and thumbnails on demand')
+    _add_common_arguments(serve_parser)
+    serve_parser.add_argument('-b', '--bind', default='127.0.0.1',
+                              help='address to listen on (default: '
+                              '127.0.0.1)')
+    serve_parser.add_argument('-p', '--port', type=int, default=8000,
+                              help='port to listen on (default: 8000)')
+
+    prune_parser = commands.add_parser(
+        'prune', help='remove the output files that the albums and theme '
+        'no longer produce')
+    _add_common_arguments(prune_parser)
+    prune_parser.add_argument('-n', '--dry-run', action='store_true',
+                              help='only list the files that would be '
+                              'removed')
+
+    publish_parser = commands.add_parser(
+        'publish', help='send the output files changed since the last '
+        'publish to SIGLICAN_PUBLISH')
+    _add_common_arguments(publish_parser)
+    publish_parser.add_argument('--target', help='directory or s3://bucket/'
+                                'prefix URL (overrides SIGLICAN_PUBLISH)')
+    publish_parser.add_argument('-n', '--dry-run', action='store_true',
+                                help='only list what would be uploaded and '
+                                'deleted')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel,
+                        format='%(levelname)s: %(message)s')
+    settings = load_settings(args)
+
+    if args.command in ('build', 'merge'):
+        if args.command == 'build':
+            gallery = build(settings)
+        else:
+            # the pages are only complete once the shards are merged
+            gallery = build(settings, page_context(settings), merge=True)
+        failed = (gallery.stats['image_failed'] +
+                  gallery.stats['video_failed'] +
+                  gallery.stats.get('publish_failed', 0))
+        return 1 if failed else 0
+    elif args.command == 'watch':
+        watch(settings, args.interval)
+        return 0
+    elif args.command == 'serve':
+        serve(settings, args.bind, args.port)
+        return 0
+    elif args.command == 'prune':
+        prune(settings, args.dry_run)
+        return 0
+    elif args.command == 'publish':
+        gallery = publish(settings, args.target, args.dry_run)
+        return 1 if gallery.stats.get('publish_failed') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,6 +24,7 @@
 ##              in utils.py (which uses Django calls)
 
 import locale
+import os
 import sys
 
 # the following appears to be from Django and/or Jinja
@@ -35,6 +36,7 @@ if not PY2:
     unichr = chr
     strxfrm = locale.strxfrm
     from urllib.parse import quote as url_quote
+    from os import replace
 else:
     text_type = unicode  # NOQA
     string_types = (str, unicode)  # NOQA
@@ -45,6 +47,24 @@ else:
 
     from urllib import quote as url_quote  # NOQA
 
+    def replace(src, dst):
+        # os.rename is atomic on POSIX but refuses to overwrite on Windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def makedirs(path):
+    """Create ``path`` and its parents unless it is a directory already.
+
+    Python 2 has no ``exist_ok``, and checking first is racy: the shards of
+    a build create the same output and cache directories concurrently.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
 # the following appears to be from
 # http://lucumr.pocoo.org/2011/1/22/forwards-compatible-python/
 class UnicodeMixin(object):
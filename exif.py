@@ -0,0 +1,321 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Additional copyright notice:
+#
+# get_exif_tags and its helpers are ported from Sigal, Copyright (c) 2009-2014
+# - Simon Conseil, under the same license. Several lines of code concerning
+# extraction of GPS data from EXIF tags where taken from a GitHub Gist by Eran
+# Sandler at
+#
+#   https://gist.github.com/erans/983821
+#
+# and partially modified. The code in question is licensed under MIT license.
+
+"""EXIF metadata of images.
+
+:func:`read_jpeg_header` reads the markers of a JPEG file up to its frame
+header (SOF), decodes the few EXIF tags siglican uses from the APP1 segment
+and skips everything else, image data and maker notes included. Values have
+the same form as those of PIL's ``_getexif``: rationals are ``(numerator,
+denominator)`` tuples. PIL is only imported for files this reader does not
+understand.
+"""
+
+import logging
+import os
+import struct
+from datetime import datetime
+
+from . import compat
+
+#: Tags read from the main (IFD0) and EXIF directories.
+EXIF_TAGS = {
+    0x0112: 'Orientation',
+    0x829A: 'ExposureTime',
+    0x829D: 'FNumber',
+    0x8827: 'ISOSpeedRatings',
+    0x9003: 'DateTimeOriginal',
+    0x920A: 'FocalLength',
+}
+
+#: Tags read from the GPS directory.
+GPS_TAGS = {
+    0x0001: 'GPSLatitudeRef',
+    0x0002: 'GPSLatitude',
+    0x0003: 'GPSLongitudeRef',
+    0x0004: 'GPSLongitude',
+}
+
+_EXIF_IFD = 0x8769
+_GPS_IFD = 0x8825
+
+# size in bytes of each TIFF field type
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8}
+_TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'L', 6: 'b', 8: 'h', 9: 'l'}
+
+# frame headers, which hold the image size; C4, C8 and CC are other markers
+_SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                          0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+_SOS = 0xDA
+_APP1 = 0xE1
+
+
+class UnsupportedHeader(ValueError):
+    """The file is not a JPEG file this reader understands."""
+
+
+def read_jpeg_header(path):
+    """Return ``((width, height), tags)`` read from the header of the JPEG
+    file ``path``, ``tags`` holding the values of :data:`EXIF_TAGS` and a
+    ``GPSInfo`` dict of :data:`GPS_TAGS` that are present.
+
+    Raises :class:`UnsupportedHeader` for anything unusual, so that the
+    caller can fall back to a complete parser, and IOError if ``path``
+    can't be read.
+    """
+    tags = None
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise UnsupportedHeader('no JPEG signature')
+        while True:
+            marker = _next_marker(f)
+            if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                continue  # markers without a segment
+            length = _unpack('>H', f.read(2))[0] - 2
+            if length < 0:
+                raise UnsupportedHeader('bad segment length')
+            if marker in _SOF_MARKERS:
+                height, width = _unpack('>xHH', f.read(5))
+                return (width, height), tags or {}
+            if marker == _SOS:
+                raise UnsupportedHeader('no frame header before the scan')
+            if marker == _APP1 and tags is None:
+                segment = f.read(length)
+                if segment[:6] == b'Exif\x00\x00':
+                    tags = _read_tiff(segment[6:])
+                continue
+            f.seek(length, 1)
+
+
+def _next_marker(f):
+    byte = f.read(1)
+    if byte != b'\xff':
+        raise UnsupportedHeader('expected a marker')
+    while byte == b'\xff':  # fill bytes
+        byte = f.read(1)
+    if not byte:
+        raise UnsupportedHeader('truncated file')
+    return ord(byte)
+
+
+def _unpack(fmt, data):
+    try:
+        return struct.unpack(fmt, data)
+    except struct.error:
+        raise UnsupportedHeader('truncated segment')
+
+
+def _read_tiff(data):
+    """Decode the wanted tags of the TIFF structure in ``data``."""
+    if data[:2] == b'II':
+        order = '<'
+    elif data[:2] == b'MM':
+        order = '>'
+    else:
+        raise UnsupportedHeader('bad TIFF byte order')
+    magic, offset = _unpack(order + 'HL', data[2:8])
+    if magic != 42:
+        raise UnsupportedHeader('bad TIFF magic')
+
+    tags = {}
+    pointers = _read_ifd(data, order, offset, EXIF_TAGS, tags)
+    if _EXIF_IFD in pointers:
+        _read_ifd(data, order, pointers[_EXIF_IFD], EXIF_TAGS, tags)
+    if _GPS_IFD in pointers:
+        gps = {}
+        _read_ifd(data, order, pointers[_GPS_IFD], GPS_TAGS, gps)
+        tags['GPSInfo'] = gps
+    return tags
+
+
+def _read_ifd(data, order, offset, names, tags):
+    """Store the tags of the directory at ``offset`` found in ``names`` into
+    ``tags``, and return its sub-directory pointers."""
+    count = _unpack(order + 'H', data[offset:offset + 2])[0]
+    pointers = {}
+    for i in range(count):
+        start = offset + 2 + i * 12
+        tag, kind, n, value = _unpack(order + 'HHL4s',
+                                      data[start:start + 12])
+        if tag in (_EXIF_IFD, _GPS_IFD):
+            pointers[tag] = _unpack(order + 'L', value)[0]
+            continue
+        if tag not in names or kind not in _TYPE_SIZES:
+            continue
+        size = _TYPE_SIZES[kind] * n
+        if size > 4:
+            at = _unpack(order + 'L', value)[0]
+            value = data[at:at + size]
+            if len(value) != size:
+                raise UnsupportedHeader('value out of bounds')
+        tags[names[tag]] = _decode(order, kind, n, value[:size])
+    return pointers
+
+
+def _decode(order, kind, n, value):
+    if kind == 2:  # ASCII, cut at the terminating NUL
+        return value.split(b'\x00', 1)[0].decode('latin-1')
+    if kind == 7:  # UNDEFINED
+        return value
+    if kind in (5, 10):  # (signed) rationals
+        fmt = 'L' if kind == 5 else 'l'
+        nums = _unpack(order + fmt * (2 * n), value)
+        values = tuple(zip(nums[::2], nums[1::2]))
+    else:
+        values = _unpack(order + _TYPE_FORMATS[kind] * n, value)
+    return values[0] if n == 1 else values
+
+
+def _decompression_bomb_errors():
+    from .image import DECOMPRESSION_BOMB_ERRORS
+    return DECOMPRESSION_BOMB_ERRORS
+
+
+def _get_exif_data(filename):
+    """Return a dict with EXIF data: the tags siglican uses, read from the
+    JPEG header alone, or all tags read by PIL when the header is unusual."""
+
+    try:
+        return read_jpeg_header(filename)[1]
+    except UnsupportedHeader as e:
+        logging.getLogger(__name__).debug(
+            u'Reading EXIF data of %s with PIL: %s', filename, e)
+
+    from PIL import Image as PILImage
+    from PIL.ExifTags import TAGS, GPSTAGS
+
+    img = PILImage.open(filename)
+    exif = img._getexif() or {}
+    data = {TAGS.get(tag, tag): value for tag, value in exif.items()}
+
+    if 'GPSInfo' in data:
+        data['GPSInfo'] = {GPSTAGS.get(tag, tag): value
+                           for tag, value in data['GPSInfo'].items()}
+    return data
+
+
+def _rational(v):
+    """Return ``v``, a ``(numerator, denominator)`` tuple or a rational
+    number from PIL, as a tuple."""
+
+    if isinstance(v, tuple):
+        return v
+    return (v.numerator, v.denominator)
+
+
+def dms_to_degrees(v):
+    """Convert degree/minute/second to decimal degrees."""
+
+    d, m, s = [float(n) / float(q) for n, q in map(_rational, v)]
+    return d + (m / 60.0) + (s / 3600.0)
+
+def get_exif_tags(source):
+    """Read EXIF tags from file @source and return a tuple of two dictionaries,
+    the first one containing the raw EXIF data, the second one a simplified
+    version with common tags.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    if os.path.splitext(source)[1].lower() not in ('.jpg', '.jpeg'):
+        return (None, None)
+
+    try:
+        data = _get_exif_data(source)
+    except (IOError, IndexError, TypeError, AttributeError) + \
+            _decompression_bomb_errors():
+        logger.warning(u'Could not read EXIF data from %s', source)
+        return (None, None)
+
+    simple = {}
+
+    # Provide more accessible tags in the 'simple' key
+    if 'FNumber' in data:
+        fnumber = _rational(data['FNumber'])
+        simple['fstop'] = float(fnumber[0]) / fnumber[1]
+
+    if 'FocalLength' in data:
+        focal = _rational(data['FocalLength'])
+        simple['focal'] = round(float(focal[0]) / focal[1])
+
+    if 'ExposureTime' in data:
+        if isinstance(data['ExposureTime'], int):
+            simple['exposure'] = str(data['ExposureTime'])
+        elif hasattr(data['ExposureTime'], 'denominator') or \
+                isinstance(data['ExposureTime'], tuple):
+            simple['exposure'] = '{0}/{1}'.format(
+                *_rational(data['ExposureTime']))
+        else:
+            logger.warning('Unknown format for ExposureTime: %r (%s)',
+                           data['ExposureTime'], source)
+
+    if 'ISOSpeedRatings' in data:
+        simple['iso'] = data['ISOSpeedRatings']
+
+    if 'DateTimeOriginal' in data:
+        try:
+            # Remove null bytes at the end if necessary
+            date = data['DateTimeOriginal'].rsplit('\x00')[0]
+            simple['dateobj'] = datetime.strptime(date, '%Y:%m:%d %H:%M:%S')
+            dt = simple['dateobj'].strftime('%A, %d. %B %Y')
+
+            if compat.PY2:
+                simple['datetime'] = dt.decode('utf8')
+            else:
+                simple['datetime'] = dt
+        except (ValueError, TypeError) as e:
+            logger.warning(u'Could not parse DateTimeOriginal of %s: %s',
+                           source, e)
+
+    if 'GPSInfo' in data:
+        info = data['GPSInfo']
+        lat_info = info.get('GPSLatitude')
+        lon_info = info.get('GPSLongitude')
+        lat_ref_info = info.get('GPSLatitudeRef')
+        lon_ref_info = info.get('GPSLongitudeRef')
+
+        if lat_info and lon_info and lat_ref_info and lon_ref_info:
+            try:
+                lat = dms_to_degrees(lat_info)
+                lon = dms_to_degrees(lon_info)
+            except (ZeroDivisionError, ValueError):
+                logger.warning('Failed to read GPS info for %s', source)
+                lat = lon = None
+
+            if lat and lon:
+                simple['gps'] = {
+                    'lat': - lat if lat_ref_info != 'N' else lat,
+                    'lon': - lon if lon_ref_info != 'E' else lon,
+                }
+
+    return (data, simple)
@@ -0,0 +1,1284 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Gallery scanning and media processing, independent of Pelican. Used by the
+# Pelican generator in siglican.py and by the command line interface in cli.py.
+
+from __future__ import print_function
+
+import os
+import sys
+import locale
+import logging
+import fnmatch
+import hashlib
+import shutil
+import threading
+import time
+from collections import defaultdict
+from .compat import PY2
+from .album import Album
+from . import instrument
+from .assets import build_bundles
+from .archive import write_archive
+from .cache import (AlbumTreeCache, Backlog, BuildJournal, ChangeSet,
+                    DerivativeCache, directory_snapshot, MetadataCache,
+                    OutputManifest, Quarantine, SpriteIndex)
+from .prefetch import Prefetcher
+from . import utils
+from .utils import file_digest, MemoryBudget, place_file, Status
+
+logger = logging.getLogger(__name__)
+
+# Default config from Sigal's settings module. These have been changed to
+# upper case because Pelican does not recognize lower case configuration names.
+# note: if a default is changed, please also update README.md
+_DEFAULT_SIGLICAN_SETTINGS = {
+    'SIGLICAN_ALBUMS_SORT_REVERSE': False,
+    'SIGLICAN_AUTOROTATE_IMAGES': True,
+    'SIGLICAN_BUILD_REPORT': 'build-report.json',
+    'SIGLICAN_BUILD_REPORT_SLOWEST': 10,
+    'SIGLICAN_BUNDLE_ASSETS': False,
+    'SIGLICAN_CACHE_PATH': None,
+    'SIGLICAN_COLORBOX_COLUMN_SIZE': 4,
+    'SIGLICAN_COPY_EXIF_DATA': False,
+    'SIGLICAN_DEDUPLICATE': True,
+    'SIGLICAN_DESTINATION': 'gallery',
+    'SIGLICAN_FILES_TO_COPY': (),
+    'SIGLICAN_FILE_PLACEMENT': ['reflink', 'hardlink', 'copy_file_range', 'copy'],
+    'SIGLICAN_IGNORE_DIRECTORIES': ['.'],
+    'SIGLICAN_IGNORE_FILES': [],
+    'SIGLICAN_IMG_PROCESSOR': 'ResizeToFit',
+    'SIGLICAN_IMG_SIZE': (640, 480),
+    'SIGLICAN_INDEX_IN_URL': False,
+    'SIGLICAN_JOB_BUDGET': None,
+    'SIGLICAN_KEEP_ORIG': False,
+    'SIGLICAN_JPG_OPTIONS': {'quality': 85, 'optimize': True, 'progressive': True},
+    'SIGLICAN_JPG_QUALITY_RANGE': (60, 95),
+    'SIGLICAN_JPG_QUALITY_TRIALS': 6,
+    'SIGLICAN_JPG_TARGET_SSIM': None,
+    'SIGLICAN_LINKS': '',
+    'SIGLICAN_LOCALE': '',
+    'SIGLICAN_MEDIAS_SORT_ATTR': 'filename',
+    'SIGLICAN_MEDIAS_SORT_REVERSE': False,
+    'SIGLICAN_MAKE_THUMBS': True,
+    'SIGLICAN_MAX_IMAGE_PIXELS': None,
+    'SIGLICAN_MEMORY_BUDGET': 1 << 30,
+    'SIGLICAN_METADATA_CACHE': True,
+    'SIGLICAN_ORIG_DIR': 'original',
+    'SIGLICAN_ORIG_LINK': False,
+    'SIGLICAN_PREFETCH_DEPTH': 0,
+    'SIGLICAN_PREFETCH_MEMORY': 256 << 20,
+    'SIGLICAN_PROCESS_MEDIA': True,
+    'SIGLICAN_PROFILE': None,
+    'SIGLICAN_PRUNE': False,
+    'SIGLICAN_PUBLISH': None,
+    'SIGLICAN_PUBLISH_CACHE_CONTROL': {
+        '.html': 'no-cache', '*': 'public, max-age=3600',
+        'bundle': 'public, max-age=31536000, immutable'},
+    'SIGLICAN_PUBLISH_ENDPOINT': None,
+    'SIGLICAN_PUBLISH_WORKERS': 8,
+    'SIGLICAN_SHARD': None,
+    'SIGLICAN_SHARED_CACHE': None,
+    'SIGLICAN_SHARED_CACHE_SIZE': 10 << 30,
+#    'PLUGINS': [],
+#    'PLUGIN_PATHS': [],
+    'SIGLICAN_SOURCE': 'siglican',
+    'SIGLICAN_THEME': 'colorbox',
+    'SIGLICAN_THUMB_DIR': 'thumbs',
+    'SIGLICAN_THUMB_FIT': True,
+    'SIGLICAN_THUMB_PREFIX': '',
+    'SIGLICAN_THUMB_SIZE': (200, 150),
+    'SIGLICAN_THUMB_SPRITE_COUNT': 100,
+    'SIGLICAN_THUMB_SPRITES': False,
+    'SIGLICAN_THUMB_SUFFIX': '',
+    'SIGLICAN_TIME_BUDGET': None,
+    'SIGLICAN_TRACE': None,
+    'SIGLICAN_VIDEO_SIZE': (480, 360),
+    'SIGLICAN_WEBM_OPTIONS': ['-crf', '10', '-b:v', '1.6M',
+                              '-qmin', '4', '-qmax', '63'],
+    'SIGLICAN_WORKERS': 1,
+    'SIGLICAN_WRITE_HTML': True,
+    'SIGLICAN_ZIP_GALLERY': False,
+    'SIGLICAN_ZIP_MEDIA_FORMAT': 'resized',
+}
+
+
+def get_settings(settings=None):
+    """Return ``settings`` completed with the siglican defaults."""
+    settings = dict(settings or {})
+    for k, v in _DEFAULT_SIGLICAN_SETTINGS.items():
+        settings.setdefault(k, v)
+    return settings
+
+
+#: Directory of SIGLICAN_CACHE_PATH holding the state of shard builds.
+SHARDS_DIR = 'shards'
+
+
+def parse_shard(value):
+    """Return the ``(index, count)`` of the shard ``'i/N'`` (or of an
+    ``(i, N)`` pair), 1 <= i <= N. Raises ValueError if it is invalid."""
+    if isinstance(value, (tuple, list)):
+        index, count = value
+    else:
+        index, count = value.split('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError('shard %d/%d does not exist' % (index, count))
+    return index, count
+
+
+def in_shard(relpath, shard):
+    """Whether the media at ``relpath`` belongs to ``shard``, an ``(index,
+    count)`` pair. The same on every machine, as the hash of the path does
+    not depend on the platform or on Python's hash seed."""
+    key = relpath.replace(os.sep, '/').encode('utf-8')
+    return int(hashlib.md5(key).hexdigest(), 16) % shard[1] == shard[0] - 1
+
+
+def resolve_pelican_paths(settings):
+    """Derive the source, theme and destination directories from the
+    Pelican PATH and OUTPUT_PATH settings."""
+    init_source = settings['SIGLICAN_SOURCE']
+    settings['SIGLICAN_SOURCE'] = os.path.normpath(settings['PATH'] +
+        "/../" + settings['SIGLICAN_SOURCE'] + '/images')
+    settings['SIGLICAN_THEME'] = os.path.normpath(settings['PATH'] +
+        "/../" + init_source + "/" + settings['SIGLICAN_THEME'])
+    settings['SIGLICAN_DESTINATION'] = os.path.normpath(
+        settings['OUTPUT_PATH'] + "/" + settings['SIGLICAN_DESTINATION'])
+    # state kept between builds lives next to Pelican's own caches
+    if not settings['SIGLICAN_CACHE_PATH']:
+        settings['SIGLICAN_CACHE_PATH'] = os.path.join(
+            settings.get('CACHE_PATH', 'cache'), 'siglican')
+
+
+def clean_settings(settings, pathkeys=('SIGLICAN_SOURCE',)):
+    """Checks existence of directories and normalizes image size settings."""
+
+    if not settings['SIGLICAN_CACHE_PATH']:
+        settings['SIGLICAN_CACHE_PATH'] = os.path.join('cache', 'siglican')
+    if settings['SIGLICAN_SHARD'] is not None:
+        try:
+            shard = parse_shard(settings['SIGLICAN_SHARD'])
+        except (TypeError, ValueError) as e:
+            logger.error("siglican: invalid SIGLICAN_SHARD %r, expected "
+                         "'i/N': %s", settings['SIGLICAN_SHARD'], e)
+            sys.exit(1)
+        settings['SIGLICAN_SHARD'] = shard
+        # a shard build keeps its state (journal, quarantine, metadata) apart
+        # from the other shards, see Gallery.merge_shards()
+        settings['SIGLICAN_CACHE_PATH'] = os.path.join(
+            settings['SIGLICAN_CACHE_PATH'], SHARDS_DIR, '%d-of-%d' % shard)
+    # tracing and profiling can also be switched on from the environment
+    for key in ('SIGLICAN_TRACE', 'SIGLICAN_PROFILE'):
+        settings[key] = os.environ.get(key) or settings[key]
+    for key in ('SIGLICAN_BUILD_REPORT', 'SIGLICAN_TRACE',
+                'SIGLICAN_PROFILE'):
+        if settings[key]:
+            settings[key] = os.path.join(settings['SIGLICAN_CACHE_PATH'],
+                                         settings[key])
+
+    enc = locale.getpreferredencoding() if PY2 else None
+
+    # test for existence of source directories
+    for k in pathkeys:
+        if os.path.isdir(settings[k]):
+            # convert to unicode for os.walk dirname/filename
+            if PY2 and isinstance(settings[k], str):
+                settings[k] = settings[k].decode(enc)
+            logger.info("%s = %s",k,settings[k])
+        else:
+            logger.error("siglican: missing source directory %s: %s",
+                         k,settings[k])
+            sys.exit(1)
+
+    # normalize sizes as e landscape
+    for key in ('SIGLICAN_IMG_SIZE', 'SIGLICAN_THUMB_SIZE', 'SIGLICAN_VIDEO_SIZE'):
+        w, h = settings[key]
+        if h > w:
+            settings[key] = (h, w)
+            logger.warning("siglican: The %s setting should be specified "
+                           "with the largest value first.", key)
+
+    if not settings['SIGLICAN_IMG_PROCESSOR']:
+        logger.info('No Processor, images will not be resized')
+
+    known = utils.PLACEMENT_STRATEGIES + ('symlink',)
+    for strategy in settings['SIGLICAN_FILE_PLACEMENT']:
+        if strategy not in known:
+            logger.warning("siglican: unknown file placement strategy "
+                           "%r, expected one of %s", strategy,
+                           ', '.join(known))
+    settings['SIGLICAN_FILE_PLACEMENT'] = [
+        s for s in settings['SIGLICAN_FILE_PLACEMENT'] if s in known]
+
+    if settings['SIGLICAN_WORKERS'] < 1:
+        logger.warning("siglican: SIGLICAN_WORKERS must be at least 1")
+        settings['SIGLICAN_WORKERS'] = 1
+    return settings
+
+
+def find_theme(settings):
+    """Return the directory of the siglican theme.
+
+    A custom theme is looked up at ``SIGLICAN_THEME``; if it is not found
+    there, a default theme of the same name in siglican/themes is used.
+    """
+    theme = settings['SIGLICAN_THEME']
+    default_themes = os.path.normpath(os.path.join(
+                     os.path.abspath(os.path.dirname(__file__)), 'themes'))
+    if not os.path.exists(theme):
+        theme = os.path.join(default_themes, os.path.basename(theme))
+        if not os.path.exists(theme):
+            raise Exception("siglican: unable to find theme: %s" %
+                             os.path.basename(theme))
+    return theme
+
+
+# based on Sigal's Gallery class
+class Gallery(object):
+    """Albums of the source tree and the processing of their media.
+
+    ``settings`` must have been completed by :func:`get_settings` and
+    :func:`clean_settings`.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.albums = {}
+        self.root_albums = {}
+        self.stats = {'image': 0, 'image_skipped': 0, 'image_dedup': 0,
+                      'image_failed': 0, 'image_quarantined': 0,
+                      'video': 0, 'video_skipped': 0, 'video_dedup': 0,
+                      'video_failed': 0, 'video_quarantined': 0,
+                      'image_reduced': 0, 'dedup_bytes': 0, 'zip': 0,
+                      'zip_skipped': 0, 'prefetch_hits': 0,
+                      'prefetch_misses': 0, 'prefetch_bytes': 0,
+                      'prefetch_hints': 0, 'prefetch_wait': 0.0,
+                      'image_deferred': 0, 'video_deferred': 0,
+                      'shared_hits': 0, 'shared_stored': 0,
+                      'shared_evicted': 0, 'sprite': 0,
+                      'sprite_skipped': 0}
+        self.metadata = None
+        self.quarantine = None
+        self.journal = None
+        self.tree_cache = None
+        # media left for the next build by SIGLICAN_TIME/JOB_BUDGET
+        self.deferred = set()
+        self._started = time.time()
+        self._snapshots = {}
+        self._outputs = None
+        self._generate_lock = threading.Lock()
+        # guards the stats, quarantine and journal between worker threads
+        self._state_lock = threading.Lock()
+        self.budget = MemoryBudget(settings['SIGLICAN_MEMORY_BUDGET'])
+        # the settings that the qualities chosen for the SSIM target depend on
+        self._quality_key = repr([settings[k] for k in (
+            'SIGLICAN_JPG_TARGET_SSIM', 'SIGLICAN_JPG_QUALITY_RANGE',
+            'SIGLICAN_JPG_QUALITY_TRIALS', 'SIGLICAN_IMG_PROCESSOR',
+            'SIGLICAN_IMG_SIZE', 'SIGLICAN_THUMB_FIT', 'SIGLICAN_THUMB_SIZE')])
+        self.shared_cache = None
+        if settings['SIGLICAN_SHARED_CACHE']:
+            self.shared_cache = DerivativeCache(
+                settings['SIGLICAN_SHARED_CACHE'], settings)
+        instrument.start(report=bool(settings['SIGLICAN_BUILD_REPORT']),
+                         slowest=settings['SIGLICAN_BUILD_REPORT_SLOWEST'],
+                         trace=settings['SIGLICAN_TRACE'],
+                         profile=settings['SIGLICAN_PROFILE'])
+
+    def _scan_albums(self, top=None, cache=None):
+        """Add the albums of the directory tree ``top`` (by default the
+        whole source tree) to ``self.albums``.
+
+        With an :class:`~siglican.cache.AlbumTreeCache`, the albums of
+        directories that did not change, and whose sub-directories did not
+        change, are taken from the cache.
+        """
+        src_path = self.settings['SIGLICAN_SOURCE']
+        changed = set()
+        for path, dirs, files in os.walk(top or src_path, followlinks=True,
+                                         topdown=False):
+            relpath = os.path.relpath(path, src_path)
+            snapshot = directory_snapshot(path, files)
+            hit, album = False, None
+            if cache is not None and not any(
+                    os.path.normpath(os.path.join(relpath, d)) in changed
+                    for d in dirs):
+                hit, album = cache.get(relpath, snapshot)
+            self._snapshots[relpath] = snapshot
+            if not hit:
+                changed.add(relpath)
+                self._scan_album(relpath, dirs, files)
+            elif album is not None:
+                album.attach(self, self.settings)
+                self.albums[relpath] = album
+        if cache is not None and cache.loaded:
+            logger.info("siglican: %d of %d directories changed since the "
+                        "album cache was written", len(changed),
+                        len(self._snapshots))
+
+    def _scan_album(self, relpath, dirs, files):
+        """Add the album of directory ``relpath`` to ``self.albums``, or
+        remove it if it is ignored or empty. Its sub-directories must have
+        been scanned before."""
+        # ** TODO: add error checking, consider use of get(), etc.
+        self._outputs = None
+        ignore_dirs = self.settings['SIGLICAN_IGNORE_DIRECTORIES']
+        ignore_files = self.settings['SIGLICAN_IGNORE_FILES']
+        if ignore_dirs and any(fnmatch.fnmatch(relpath, ignore)
+                               for ignore in ignore_dirs):
+            logger.info('siglican: ignoring %s', relpath)
+            return
+        if ignore_files: # ** github6: if no ignore_files, then no files?
+            files_path = {os.path.join(relpath, f) for f in files}
+            for ignore in ignore_files:
+                files_path -= set(fnmatch.filter(files_path, ignore))
+                ## ** TEST? unicode in list may cause mismatch
+            logger.debug('siglican: Files before filtering: %r', files)
+            files = [os.path.split(f)[1] for f in files_path]
+            logger.debug('siglican: Files after filtering: %r', files)
+
+        # Remove sub-directories that have been ignored in a previous
+        # iteration (as topdown=False, sub-directories are processed before
+        # their parent
+        for d in dirs[:]:
+            path = os.path.join(relpath, d) if relpath != '.' else d
+            if path not in self.albums.keys():
+                dirs.remove(d)
+        with instrument.stage('album', relpath):
+            album = Album(relpath, self.settings, dirs, files, self)
+
+        if not album.medias and not album.albums:
+            logger.info('siglican: Skip empty album: %r', album)
+            self.albums.pop(relpath, None)
+        else:
+            self.albums[relpath] = album
+
+    # based on Sigal's Gallery.__init__() method:
+    @instrument.phase('scan')
+    def scan(self):
+        """Scan the source tree into ``self.albums``."""
+        locale.setlocale(locale.LC_ALL, self.settings['SIGLICAN_LOCALE'])
+        if self.settings['SIGLICAN_METADATA_CACHE']:
+            self.metadata = MetadataCache(self.settings['SIGLICAN_CACHE_PATH'])
+        self.tree_cache = AlbumTreeCache(self.settings['SIGLICAN_CACHE_PATH'],
+                                         self.settings)
+
+        self._outputs = None
+        self._scan_albums(cache=self.tree_cache)
+        self.index_albums()
+        logger.debug('siglican: albums:\n%r', self.albums.values())
+
+        if self.metadata is not None:
+            self.metadata.save(keep=self.media_relpaths())
+
+        if self.settings['SIGLICAN_DEDUPLICATE']:
+            with instrument.stage('dedup'):
+                self._find_duplicates()
+
+    @instrument.phase('update')
+    def update(self, paths):
+        """Rescan the albums holding ``paths``, files or directories below
+        ``SIGLICAN_SOURCE`` that changed, and process their media.
+
+        Only the changed directories and their ancestors are read again.
+        Returns the paths of the albums whose pages are out of date: those
+        albums, and the descendants of albums whose description changed
+        (their breadcrumbs show its title).
+        """
+        if not paths:
+            return set()
+        src_path = self.settings['SIGLICAN_SOURCE']
+        dirty, described = set(), set()
+        for path in paths:
+            relpath = os.path.relpath(path, src_path)
+            if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                continue
+            if relpath == '.':
+                # the watcher lost track of the tree: start over
+                return self.rescan()
+            parent = os.path.dirname(relpath) or '.'
+            dirty.add(parent)
+            if os.path.isdir(path) or relpath in self.albums:
+                dirty.add(relpath)
+            if os.path.basename(relpath) == Album.description_file:
+                described.add(parent)
+        for relpath in list(dirty):
+            while relpath != '.':
+                relpath = os.path.dirname(relpath) or '.'
+                dirty.add(relpath)
+        for relpath in dirty:
+            # not rescanned with snapshots, see save_tree()
+            self._snapshots.pop(relpath, None)
+
+        # deepest first, as sub-albums must exist before their parent
+        depth = lambda p: -1 if p == '.' else p.count(os.sep)
+        for relpath in sorted(dirty, key=depth, reverse=True):
+            path = os.path.normpath(os.path.join(src_path, relpath))
+            if not os.path.isdir(path):
+                for key in list(self.albums):
+                    if key == relpath or key.startswith(relpath + os.sep):
+                        del self.albums[key]
+            elif relpath != '.' and relpath not in self.albums:
+                self._scan_albums(path)
+            else:
+                dirs, files = [], []
+                for name in os.listdir(path):
+                    (dirs if os.path.isdir(os.path.join(path, name))
+                     else files).append(name)
+                self._scan_album(relpath, dirs, files)
+
+        self.index_albums()
+
+        if self.metadata is not None:
+            self.metadata.save(keep=self.media_relpaths())
+        albums = [self.albums[p] for p in sorted(dirty) if p in self.albums]
+        if self.settings['SIGLICAN_DEDUPLICATE']:
+            with instrument.stage('dedup'):
+                self._find_duplicates(set(album.path for album in albums))
+        self.process(albums)
+
+        pages = dirty & set(self.albums)
+        for parent in described:
+            pages.update(p for p in self.albums if parent == '.' or
+                         p.startswith(parent + os.sep))
+        return pages
+
+    def rescan(self):
+        """Scan and process the whole source tree again. Returns the paths
+        of all albums."""
+        self.albums.clear()
+        self._snapshots.clear()
+        self.scan()
+        self.process()
+        return set(self.albums)
+
+    def index_albums(self):
+        """Link the albums to their parent and children and precompute
+        their breadcrumbs and recursive totals, as well as
+        ``self.root_albums``, so that templates don't walk the tree."""
+        albums = self.albums
+        ordered = sorted(albums.values(), key=lambda album: album.depth)
+        self.root_albums = {}
+        for album in ordered:  # parents first
+            path = album.path
+            album.parent = (None if path == '.' else
+                            albums.get(os.path.dirname(path) or '.'))
+            album.children = []
+            for name in album.subdirs:
+                child = albums.get(os.path.normpath(os.path.join(path, name)))
+                if child is not None:
+                    album.children.append(child)
+            if os.sep not in path:
+                self.root_albums[path] = album
+
+            album.breadcrumb = []
+            if path != '.':
+                album.breadcrumb.append(((album.url_ext or '.'), album.title))
+                ancestor, up = album.parent, 1
+                while ancestor is not None and ancestor.path != '.':
+                    url = '/'.join([os.pardir] * up) + '/' + album.url_ext
+                    album.breadcrumb.append((url, ancestor.title))
+                    ancestor, up = ancestor.parent, up + 1
+                album.breadcrumb.reverse()
+
+        for album in reversed(ordered):  # children first
+            counts = defaultdict(int, album.medias_count)
+            dates = [media.date for media in album.medias if media.date]
+            for child in album.children:
+                for media_type, count in child.total_medias_count.items():
+                    counts[media_type] += count
+                if child.newest_date:
+                    dates.append(child.newest_date)
+            album.total_medias_count = counts
+            album.total_medias = sum(counts.values())
+            album.newest_date = max(dates) if dates else None
+
+    def get_albums(self, path):
+        """Yield ``(path, album)`` for every album below ``path``, each
+        before its descendants."""
+        stack = list(reversed(self.albums[path].children))
+        while stack:
+            album = stack.pop()
+            yield album.path, album
+            stack.extend(reversed(album.children))
+
+    def save_tree(self):
+        """Write the album tree cache. Call it after writing the pages, so
+        that the album covers they looked up are cached too."""
+        if self.tree_cache is None:
+            return
+        try:
+            self.tree_cache.save(self._snapshots, self.albums)
+        except (IOError, OSError) as e:
+            logger.error("siglican: could not write album cache: %s", e)
+
+    def media_relpaths(self):
+        """Paths of all media, relative to ``SIGLICAN_SOURCE``."""
+        return set(media.relpath for album in self.albums.values()
+                   for media in album.medias)
+
+    def _find_duplicates(self, albums=None):
+        """Mark media whose content is identical to a media found earlier.
+
+        Only files sharing a size are hashed, so the cost on a tree without
+        duplicates is one stat per media. With a set of album paths in
+        ``albums``, only the files sharing a size with a media of these
+        albums are considered again.
+        """
+        by_size = defaultdict(list)
+        for album in self.albums.values():
+            for media in album.medias:
+                try:
+                    size = os.path.getsize(media.src_path)
+                except OSError:
+                    continue
+                by_size[(media.type, size)].append(media)
+
+        for medias in by_size.values():
+            if albums is not None and not any(media.path in albums
+                                              for media in medias):
+                continue
+            for media in medias:
+                media.duplicate_of = None
+            if len(medias) < 2:
+                continue
+            originals = {}
+            for media in medias:
+                try:
+                    digest = file_digest(media.src_path)
+                except (IOError, OSError) as e:
+                    logger.warning("siglican: could not hash %s: %s",
+                                   media.src_path, e)
+                    continue
+                if digest in originals:
+                    media.duplicate_of = originals[digest]
+                    logger.debug("siglican: %r is a duplicate of %r",
+                                 media, media.duplicate_of)
+                else:
+                    originals[digest] = media
+
+    def _is_done(self, media):
+        """Whether the derivatives of ``media`` are complete and current.
+
+        Media recorded in the journal only need their output to exist. Media
+        unknown to the journal (e.g. built before it existed) get all their
+        outputs checked and are recorded if complete.
+        """
+        done = self.journal.status(media)
+        if done:
+            return os.path.isfile(media.dst_path)
+        if done is None:
+            outputs = [media.dst_path]
+            if self.settings['SIGLICAN_MAKE_THUMBS']:
+                outputs.append(media.thumb_path)
+            if all(os.path.isfile(p) for p in outputs):
+                self.journal.record(media)
+                return True
+        # the source changed since its derivatives were written
+        return False
+
+    def _pending(self, media, force=False):
+        """Whether ``media`` must be processed; counts it as skipped if not.
+        Media that are done are only processed again with ``force``."""
+        with self._state_lock:
+            if not force and self._is_done(media):
+                logger.info("siglican: %s exists - skipping", media.filename)
+                self.stats[media.type + '_skipped'] += 1
+                return False
+            if media in self.quarantine:
+                logger.debug("siglican: %s failed before and is unchanged - "
+                             "skipping", media.src_path)
+                self.stats[media.type + '_quarantined'] += 1
+                return False
+        return True
+
+    def _process_media(self, media, force=False):
+        """Create the resized media and thumbnail unless they are done (or
+        ``force`` is set)."""
+        if self._pending(media, force):
+            self._process_pending(media)
+
+    def _process_pending(self, media, fp=None):
+        """Create the resized media and thumbnail, reading the source from
+        ``fp`` if given, or take them from the shared cache."""
+        key = None
+        if self.shared_cache is not None:
+            with instrument.stage('shared_cache', media.relpath):
+                try:
+                    key = self.shared_cache.key(media)
+                except (IOError, OSError) as e:
+                    logger.debug("siglican: cannot hash %s: %s",
+                                 media.src_path, e)
+                if key is not None and self.shared_cache.fetch(media, key):
+                    logger.info("siglican: %s found in the shared cache",
+                                media.relpath)
+                    with self._state_lock:
+                        self.stats['shared_hits'] += 1
+                        self.quarantine.discard(media)
+                        self.journal.record(media)
+                    return
+
+        with self._state_lock:
+            self.stats[media.type] += 1
+        logger.info("siglican: processing %r , source: %s, dst: %s",
+                    media, media.src_path, media.dst_path)
+        logger.debug("MEDIA TYPE: %s", media.type)
+        # create/move resized images and thumbnails to output dirs:
+        outpath = os.path.dirname(media.dst_path)
+        qualities = None
+        if media.type == 'image':
+            from .image import process_image, ImageTooLargeError
+            qualities = self._jpeg_qualities(media)
+            known = dict(qualities)
+            try:
+                cost, reduce = self._estimate_memory(media, fp)
+            except ImageTooLargeError as e:
+                # not quarantined: a larger budget may be set for the next
+                # build
+                logger.error("siglican: not processing %s: %s",
+                             media.src_path, e)
+                with self._state_lock:
+                    self.stats['image_failed'] += 1
+                return
+            with self.budget.reserve(cost):
+                with instrument.stage('process_image', media.relpath):
+                    status = process_image(media.src_path, outpath,
+                                           self.settings, reduce=reduce,
+                                           fp=fp, qualities=qualities)
+        elif media.type == 'video':
+            from .video import process_video
+            with instrument.stage('process_video', media.relpath):
+                status = process_video(media.src_path, outpath, self.settings)
+
+        stored = False
+        if key is not None and status != Status.FAILURE:
+            with instrument.stage('shared_cache', media.relpath):
+                stored = self.shared_cache.store(media, key)
+
+        with self._state_lock:
+            self.stats['shared_stored'] += stored
+            if status == Status.FAILURE:
+                self.stats[media.type + '_failed'] += 1
+                self.quarantine.add(media)
+            else:
+                self.quarantine.discard(media)
+                self.journal.record(media)
+                if qualities and qualities != known and \
+                        self.metadata is not None:
+                    self.metadata.set_extra(media, 'jpeg_quality',
+                                            (self._quality_key, qualities))
+                if self.settings['SIGLICAN_KEEP_ORIG']:
+                    # a linked original changed with its source: resend it
+                    utils.changed_paths.add(os.path.abspath(media.orig_path))
+                if media.type == 'image' and reduce > 1:
+                    self.stats['image_reduced'] += 1
+
+    def _jpeg_qualities(self, media):
+        """Return the JPEG qualities chosen for ``media`` with
+        SIGLICAN_JPG_TARGET_SSIM by a previous build with the same settings,
+        as a dict for processing to fill in."""
+        if self.metadata is None:
+            return {}
+        cached = self.metadata.get_extra(media, 'jpeg_quality')
+        if cached is None or cached[0] != self._quality_key:
+            return {}
+        return dict(cached[1])
+
+    def _estimate_memory(self, media, fp=None):
+        """Return the estimated memory use of processing image ``media`` and
+        the factor to shrink it by, see :func:`image.estimate_memory`.
+
+        A JPEG that would take more than its share of the budget at full
+        size is shrunk while decoding. Raises
+        :class:`image.ImageTooLargeError` for other images that do not fit
+        the budget.
+        """
+        from .image import estimate_memory
+        budget = self.budget.limit
+        share = budget // self.settings['SIGLICAN_WORKERS'] if budget else None
+        try:
+            return estimate_memory(fp if fp is not None else media.src_path,
+                                   self.settings, share, budget)
+        except (IOError, OSError, ValueError, SyntaxError) as e:
+            # process_image reports the problem
+            logger.debug("siglican: cannot estimate %s: %s", media.src_path, e)
+            if fp is not None:
+                fp.seek(0)
+            return 0, 1
+
+    def _progress(self):
+        if logger.getEffectiveLevel() > logging.INFO:
+            print('.', end='')
+            sys.stdout.flush()
+
+    def _within_budget(self, jobs):
+        """Whether another media can start after ``jobs`` were started, given
+        SIGLICAN_JOB_BUDGET and SIGLICAN_TIME_BUDGET."""
+        budget = self.settings['SIGLICAN_JOB_BUDGET']
+        if budget is not None and jobs >= budget:
+            return False
+        budget = self.settings['SIGLICAN_TIME_BUDGET']
+        return budget is None or time.time() - self._started < budget
+
+    def _prioritize(self, medias, backlog):
+        """Sort ``medias``: album covers first, then the media left by the
+        previous build in their order, then the newest sources."""
+        covers = set()
+        for album in self.albums.values():
+            cover = album.cover if album.medias else None
+            # a duplicate cover is ready as soon as its original is
+            covers.add(getattr(cover, 'duplicate_of', None) or cover)
+
+        def key(media):
+            try:
+                mtime = os.stat(media.src_path).st_mtime
+            except OSError:
+                mtime = 0
+            return (media not in covers, backlog.position(media), -mtime)
+
+        return sorted(medias, key=key)
+
+    def _process_all(self, medias, backlog=None):
+        """Process ``medias`` with SIGLICAN_WORKERS threads, reading the
+        sources ahead with SIGLICAN_PREFETCH_DEPTH, until the budget runs
+        out. Returns the media that were not started."""
+        pending = [m for m in medias if self._pending(m)]
+        budgeted = (self.settings['SIGLICAN_JOB_BUDGET'] is not None or
+                    self.settings['SIGLICAN_TIME_BUDGET'] is not None)
+        if backlog is not None and (budgeted or len(backlog)):
+            pending = self._prioritize(pending, backlog)
+        depth = self.settings['SIGLICAN_PREFETCH_DEPTH']
+        prefetcher = None
+        if depth and pending:
+            prefetcher = Prefetcher(
+                [(m.src_path, m.type == 'image') for m in pending], depth,
+                self.settings['SIGLICAN_PREFETCH_MEMORY'])
+
+        queue = iter(pending)
+        lock = threading.Lock()
+        started = [0]
+
+        def next_media():
+            with lock:
+                if not self._within_budget(started[0]):
+                    return None
+                media = next(queue, None)
+                if media is not None:
+                    started[0] += 1
+                return media
+
+        def run(media):
+            self._progress()
+            fp = None
+            if prefetcher is not None and media.type == 'image':
+                fp = prefetcher.take(media.src_path)
+            self._process_pending(media, fp=fp)
+
+        def work():
+            while True:
+                media = next_media()
+                if media is None:
+                    return
+                try:
+                    run(media)
+                except Exception:
+                    logger.exception("siglican: failed to process %r", media)
+
+        try:
+            workers = self.settings['SIGLICAN_WORKERS']
+            if workers == 1:
+                for media in iter(next_media, None):
+                    run(media)
+            else:
+                threads = [threading.Thread(target=work,
+                                            name='siglican-%d' % i)
+                           for i in range(workers)]
+                for thread in threads:
+                    thread.daemon = True
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+                for key, value in prefetcher.stats.items():
+                    self.stats[key] += value
+        return pending[started[0]:]
+
+    def _link_duplicate(self, media):
+        """Share the derivatives of ``media.duplicate_of`` with ``media``."""
+        if self._is_done(media):
+            logger.info("siglican: %s exists - skipping", media.filename)
+            self.stats[media.type + '_skipped'] += 1
+            return
+        original = media.duplicate_of
+        if not os.path.isfile(original.dst_path):
+            # the original failed to process; give this copy its own chance
+            self._process_media(media)
+            return
+
+        pairs = [(original.dst_path, media.dst_path)]
+        if self.settings['SIGLICAN_MAKE_THUMBS']:
+            pairs.append((original.thumb_path, media.thumb_path))
+        logger.info("siglican: linking %r to derivatives of %r",
+                    media, original)
+        for src, dst in pairs:
+            if os.path.isfile(src):
+                place_file(src, dst, self.settings['SIGLICAN_FILE_PLACEMENT'])
+                self.stats['dedup_bytes'] += os.path.getsize(src)
+        self.stats[media.type + '_dedup'] += 1
+        self.journal.record(media)
+
+    def _place_original(self, media):
+        """Put the unmodified source of ``media`` in the album's orig dir."""
+        if os.path.lexists(media.orig_path) and \
+                utils._is_placed(media.src_path, media.orig_path):
+            return
+        if self.settings['SIGLICAN_ORIG_LINK']:
+            strategies = ['symlink']
+        else:
+            strategies = self.settings['SIGLICAN_FILE_PLACEMENT']
+        try:
+            place_file(media.src_path, media.orig_path, strategies)
+        except (IOError, OSError) as e:
+            logger.error("siglican: could not place original of %r: %s",
+                         media, e)
+
+    def start_archives(self, albums=None):
+        """Start building the out of date ZIP archives (of ``albums``, or of
+        all albums) in the background, if enabled, and return the thread (or
+        None).
+
+        Archives only need the processed media, so this can run while the
+        album pages are rendered.
+        """
+        if not self.settings['SIGLICAN_ZIP_GALLERY'] or \
+                self.settings['SIGLICAN_SHARD'] is not None:
+            return None
+        archiver = threading.Thread(target=self._write_archives,
+                                    args=(albums,), name='siglican-zip')
+        archiver.start()
+        return archiver
+
+    def _write_archives(self, albums=None):
+        """Build the per-album ZIP archives that are out of date."""
+        if albums is None:
+            albums = list(self.albums.values())
+        for album in albums:
+            if not album.zip:
+                continue
+            try:
+                with instrument.stage('archive', album.path):
+                    written = write_archive(album, self.settings)
+                if written:
+                    self.stats['zip'] += 1
+                else:
+                    self.stats['zip_skipped'] += 1
+            except (IOError, OSError) as e:
+                logger.error("siglican: failed to write ZIP archive of %r: %s",
+                             album, e)
+
+    def _write_sprites(self, albums):
+        """Pack the thumbnails of each of ``albums`` into sprite sheets,
+        unless its thumbnails are unchanged since the last build."""
+        from .sprites import set_sprites, write_sprites
+        sprites = SpriteIndex(self.settings['SIGLICAN_CACHE_PATH'])
+        sprites.prune(self.albums)
+        for album in albums:
+            try:
+                with instrument.stage('sprites', album.path):
+                    written = write_sprites(album, self.settings, sprites)
+                if written:
+                    self.stats['sprite'] += 1
+                else:
+                    self.stats['sprite_skipped'] += 1
+            except (IOError, OSError) as e:
+                logger.error("siglican: failed to write the sprite sheets of "
+                             "%r: %s", album, e)
+                set_sprites(album, None)
+        sprites.save()
+
+    @instrument.phase('process')
+    def process(self, albums=None):
+        """Create the output directories and process the media of
+        ``albums``, or of every album."""
+
+        # github7 ** improve exception catching
+        # github8: images are processed by SIGLICAN_WORKERS threads, see
+        # _process_all()
+
+        # generate thumbnails, process images, and move them to the destination
+        if logger.getEffectiveLevel() > logging.INFO:
+            print('siglican is processing media: ', end='')
+            sys.stdout.flush()
+        if albums is None:
+            albums = list(self.albums.values())
+        medias, duplicates = [], []
+        utils.placement_counts.clear()
+        self._started = time.time()
+        self.open_state()
+        backlog = Backlog(self.settings['SIGLICAN_CACHE_PATH'])
+        for album in albums:
+            logger.info("siglican: processing album: %s", album.path)
+            album.create_output_directories()
+            for media in album.medias:
+                # duplicates are linked once every original has been processed
+                if media.duplicate_of is not None:
+                    duplicates.append(media)
+                else:
+                    medias.append(media)
+        shard = self.settings['SIGLICAN_SHARD']
+        if shard is not None:
+            # duplicates are linked by the merge, once all shards are done
+            medias = [m for m in medias if in_shard(m.relpath, shard)]
+            duplicates = []
+        deferred = self._process_all(medias, backlog)
+        self.deferred = set(deferred)
+        for media in duplicates:
+            self._progress()
+            if media.duplicate_of in self.deferred and \
+                    not self._is_done(media):
+                deferred.append(media)
+                self.deferred.add(media)
+                continue
+            self._link_duplicate(media)
+        for media in deferred:
+            self.stats[media.type + '_deferred'] += 1
+        if self.settings['SIGLICAN_KEEP_ORIG']:
+            for album in albums:
+                for media in album.medias:
+                    if shard is None or in_shard(media.relpath, shard):
+                        self._place_original(media)
+        if self.settings['SIGLICAN_THUMB_SPRITES'] and shard is None:
+            self._write_sprites(albums)
+        if logger.getEffectiveLevel() > logging.INFO:
+            print('')
+        self.close_state()
+        if self.shared_cache is not None:
+            self.stats['shared_evicted'] += self.shared_cache.evict()
+        backlog.update([m.relpath for m in medias + duplicates],
+                       [m.relpath for m in deferred], self.media_relpaths())
+        if deferred:
+            logger.warning("siglican: build budget exhausted, %d media left "
+                           "for the next build (see %s)", len(deferred),
+                           backlog.path)
+
+    def open_state(self):
+        """Load the quarantine and the build journal."""
+        self.quarantine = Quarantine(self.settings['SIGLICAN_CACHE_PATH'])
+        self.quarantine.prune(self.media_relpaths())
+        self.journal = BuildJournal(self.settings['SIGLICAN_CACHE_PATH'],
+                                    self.settings['SIGLICAN_DESTINATION'],
+                                    self.settings)
+
+    def merge_shards(self):
+        """Fold the journals, quarantines and metadata left by shard builds
+        (``build --shard i/N``) into those of this gallery, so that the
+        next :meth:`process` only links duplicates and processes what no
+        shard did. Returns the number of shards merged."""
+        cache_path = self.settings['SIGLICAN_CACHE_PATH']
+        root = os.path.join(cache_path, SHARDS_DIR)
+        if not os.path.isdir(root):
+            return 0
+        destination = self.settings['SIGLICAN_DESTINATION']
+        journal = BuildJournal(cache_path, destination, self.settings)
+        quarantine = Quarantine(cache_path)
+        metadata = MetadataCache(cache_path)
+        changes = ChangeSet(cache_path)
+        names = sorted(os.listdir(root))
+        for name in names:
+            path = os.path.join(root, name)
+            partial = BuildJournal(path, destination, self.settings)
+            logger.info("siglican: merging shard %s: %d media done", name,
+                        len(partial.entries))
+            journal.merge(partial.entries)
+            quarantine.merge(Quarantine(path).entries)
+            metadata.merge(MetadataCache(path).entries)
+            changes.add(ChangeSet(path).pending)
+        manifest = OutputManifest(cache_path)
+        if manifest.entries is not None:
+            manifest.update(changes.pending, destination)
+            manifest.save()
+        counts = set(name.partition('-of-')[2] for name in names)
+        if counts != set([str(len(names))]):
+            logger.warning("siglican: merged shards %s, which are not a "
+                           "complete set; the media of the others are "
+                           "processed now", ', '.join(names))
+        journal.close()
+        quarantine.save()
+        metadata.save()
+        changes.save()
+        shutil.rmtree(root)
+        return len(names)
+
+    def close_state(self):
+        """Save the quarantine, the JPEG qualities chosen for the media and
+        compact the build journal."""
+        self.quarantine.save()
+        self.journal.close(keep=self.media_relpaths())
+        if self.metadata is not None:
+            self.metadata.save()
+
+    def save_changes(self):
+        """Add the output files written or removed since the last call to
+        the change set of the next :meth:`publish`."""
+        destination = os.path.abspath(self.settings['SIGLICAN_DESTINATION'])
+        relpaths = [os.path.relpath(path, destination).replace(os.sep, '/')
+                    for path in utils.changed_paths
+                    if path.startswith(destination + os.sep)]
+        utils.changed_paths.clear()
+        if relpaths:
+            changes = ChangeSet(self.settings['SIGLICAN_CACHE_PATH'])
+            changes.add(relpaths)
+            changes.save()
+            manifest = OutputManifest(self.settings['SIGLICAN_CACHE_PATH'])
+            if manifest.entries is not None:
+                manifest.update(relpaths, destination)
+                manifest.save()
+
+    def expected_outputs(self):
+        """Return the paths, relative to SIGLICAN_DESTINATION, of the files
+        that the current albums and theme produce."""
+        destination = os.path.abspath(self.settings['SIGLICAN_DESTINATION'])
+        paths = set(self.outputs())
+        for album in self.albums.values():
+            if self.settings['SIGLICAN_WRITE_HTML']:
+                paths.add(os.path.join(album.dst_path, album.output_file))
+            if self.settings['SIGLICAN_ZIP_GALLERY']:
+                paths.add(os.path.join(album.dst_path,
+                                       self.settings['SIGLICAN_ZIP_GALLERY']))
+        if self.settings['SIGLICAN_THUMB_SPRITES']:
+            sprites = SpriteIndex(self.settings['SIGLICAN_CACHE_PATH'])
+            for path, album in self.albums.items():
+                entry = sprites.get(path) or {'sheets': []}
+                paths.update(os.path.join(album.dst_path, sheet)
+                             for sheet in entry['sheets'])
+        if self.settings['SIGLICAN_WRITE_HTML']:
+            # the theme's static files, see Writer
+            static = os.path.join(find_theme(self.settings), 'static')
+            for path, dirs, files in os.walk(static):
+                outdir = os.path.join(destination, 'static',
+                                      os.path.relpath(path, static))
+                paths.update(os.path.join(outdir, f) for f in files)
+            if self.settings['SIGLICAN_BUNDLE_ASSETS']:
+                bundles = build_bundles(find_theme(self.settings))
+                paths.update(os.path.join(destination, 'static',
+                                          *relpath.split('/'))
+                             for relpath, content in bundles.values())
+        return set(os.path.relpath(os.path.abspath(path), destination)
+                   .replace(os.sep, '/') for path in paths)
+
+    @instrument.phase('prune')
+    def prune(self, dry_run=False):
+        """Remove the files below SIGLICAN_DESTINATION that the current
+        albums and theme do not produce, or only log them with ``dry_run``.
+        Returns their paths, relative to the destination.
+
+        The files are listed from the output manifest; the destination is
+        only walked when there is no manifest yet.
+        """
+        self.save_changes()
+        destination = os.path.abspath(self.settings['SIGLICAN_DESTINATION'])
+        if destination == os.path.abspath(self.settings.get('OUTPUT_PATH',
+                                                            '')):
+            logger.error("siglican: not pruning %s, which is the whole "
+                         "Pelican output", destination)
+            return []
+        manifest = OutputManifest(self.settings['SIGLICAN_CACHE_PATH'])
+        if manifest.entries is None:
+            manifest.entries = set()
+            for path, dirs, files in os.walk(destination):
+                manifest.entries.update(
+                    os.path.relpath(os.path.join(path, f), destination)
+                    .replace(os.sep, '/') for f in files)
+            manifest.save()
+        orphans = sorted(manifest.entries - self.expected_outputs())
+        for relpath in orphans:
+            if dry_run:
+                logger.warning("siglican: would remove %s", relpath)
+                continue
+            logger.info("siglican: removing %s", relpath)
+            path = os.path.join(destination, *relpath.split('/'))
+            try:
+                utils.remove_output(path)
+            except OSError as e:
+                logger.error("siglican: could not remove %s: %s", path, e)
+                continue
+            # and the directories it leaves empty
+            parent = os.path.dirname(path)
+            while parent != destination:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        if dry_run:
+            self.stats['prunable'] = len(orphans)
+            return orphans
+        self.stats['pruned'] = len(orphans)
+        # also drops the orphans that were already gone
+        manifest.update(orphans, destination)
+        manifest.save()
+        self.save_changes()
+        return orphans
+
+    @instrument.phase('publish')
+    def publish(self, target=None, dry_run=False):
+        """Send the output files changed since the last publish to
+        ``target``, by default SIGLICAN_PUBLISH (see :mod:`siglican.publish`).
+        """
+        self.save_changes()
+        from .publish import publish
+        stats = publish(self.settings, target, dry_run)
+        self.stats.update(stats)
+        return stats
+
+    def outputs(self):
+        """Map the absolute path of every file derived from a media (resized
+        media, thumbnail, original) to the media."""
+        if self._outputs is None:
+            outputs = {}
+            for album in self.albums.values():
+                for media in album.medias:
+                    paths = [media.dst_path]
+                    if self.settings['SIGLICAN_MAKE_THUMBS']:
+                        paths.append(media.thumb_path)
+                    if self.settings['SIGLICAN_KEEP_ORIG']:
+                        paths.append(media.orig_path)
+                    for path in paths:
+                        outputs[os.path.abspath(path)] = media
+            self._outputs = outputs
+        return self._outputs
+
+    def generate(self, path):
+        """Create the output file ``path`` on demand, with the same
+        processing as a build, if it derives from a media.
+
+        Must be called between :meth:`open_state` and :meth:`close_state`.
+        Returns whether ``path`` exists afterwards.
+        """
+        path = os.path.abspath(path)
+        media = self.outputs().get(path)
+        if media is None:
+            return os.path.isfile(path)
+        # one media at a time, which also keeps the journal consistent
+        with self._generate_lock:
+            if os.path.isfile(path):
+                pass  # made by a concurrent request
+            elif media.orig_path and path == os.path.abspath(media.orig_path):
+                self._place_original(media)
+            elif media.duplicate_of is not None:
+                original = media.duplicate_of
+                if not os.path.isfile(original.dst_path):
+                    self._process_media(original, force=True)
+                self._link_duplicate(media)
+                if not os.path.isfile(path):
+                    self._process_media(media, force=True)
+            else:
+                self._process_media(media, force=True)
+        return os.path.isfile(path)
+
+    def update_context(self, context):
+        """Make the albums and the default settings available to templates."""
+        context['ALBUMS'] = self.albums  # ** change to SIGLICAN_ALBUMS?
+
+        context['ROOT_ALBUMS'] = self.root_albums
+
+        # update the jinja context with the default sigal settings:
+        for k,v in _DEFAULT_SIGLICAN_SETTINGS.items():
+            if not k in context:
+                context[k] = v
+
+    def _visible(self, album):
+        """Return ``album``, or a copy of it without the media deferred by
+        the build budget that have no resized file yet."""
+        hidden = set(media for media in album.medias
+                     if media in self.deferred and
+                     not os.path.isfile(media.dst_path))
+        if not hidden:
+            return album
+        # a shallow copy; copy.copy() would go through __getstate__
+        visible = object.__new__(Album)
+        visible.__dict__.update(album.__dict__)
+        visible.medias = [media for media in album.medias
+                          if media not in hidden]
+        visible.medias_count = defaultdict(int)
+        for media in visible.medias:
+            visible.medias_count[media.type] += 1
+        return visible
+
+    @instrument.phase('pages')
+    def write_pages(self, context, albums=None):
+        """Generate the index.html files of ``albums`` (paths), or of all
+        albums. ``context`` must hold the Pelican settings."""
+        theme = find_theme(self.settings)
+        logger.info("siglican theme: %s", theme)
+
+        from .writer import Writer
+        writer = Writer(context, theme, 'album')
+        selected = [album for path, album in list(self.albums.items())
+                    if albums is None or path in albums]
+        if self.settings['SIGLICAN_THUMB_SPRITES']:
+            # the media may have been processed by another run (cli.py)
+            from .sprites import read_sprites
+            sprites = SpriteIndex(self.settings['SIGLICAN_CACHE_PATH'])
+            for album in selected:
+                read_sprites(album, self.settings, sprites)
+        for album in selected:
+            writer.write(self._visible(album))
+
+        ## possible cleanup:
+        ##   - bring back Writer options that Sigal had?
+        ##   - make sure thumbnails don't break in some cases [fixed?]
+
+    def log_summary(self):
+        """Log the build stats and the media that could not be processed."""
+        self.stats['placement'] = dict(utils.placement_counts)
+        logger.info("siglican: stats: %r", self.stats)
+        if self.quarantine is None:
+            return
+        if self.quarantine.added:
+            logger.warning("siglican: failed to process %d media, they will "
+                           "be skipped until they change: %s",
+                           len(self.quarantine.added),
+                           ', '.join(self.quarantine.added))
+        skipped = (self.stats['image_quarantined'] +
+                   self.stats['video_quarantined'])
+        if skipped:
+            logger.warning("siglican: skipped %d media that failed in a "
+                           "previous build (see %s)", skipped,
+                           self.quarantine.path)
+
+    def write_report(self):
+        """Write the JSON build report if one was collected."""
+        report = instrument.finish()
+        if report is None:
+            return
+        try:
+            quarantined = (sorted(self.quarantine.entries)
+                           if self.quarantine is not None else [])
+            report.write(self.settings['SIGLICAN_BUILD_REPORT'],
+                         stats=self.stats, quarantined=quarantined)
+        except (IOError, OSError) as e:
+            logger.error("siglican: could not write build report: %s", e)
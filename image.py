@@ -20,51 +20,288 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-# Additional copyright notice:
-#
-# Several lines of code concerning extraction of GPS data from EXIF tags where
-# taken from a GitHub Gist by Eran Sandler at
-#
-#   https://gist.github.com/erans/983821
-#
-# and partially modified. The code in question is licensed under MIT license.
-
 # Copyright (c) 2014      - Scott Boone (https://github.com/sawall/)
 # Minor updates to image.py from Sigal.
 
 # TODO: merge with video.py
 
+import io
 import logging
 import os
 import pilkit.processors
+import struct
 import sys
+import threading
+import warnings
 
 from copy import deepcopy
-from datetime import datetime
-from PIL.ExifTags import TAGS, GPSTAGS
 from PIL import Image as PILImage
 from PIL import ImageOps
 from pilkit.processors import Transpose
 from pilkit.utils import save_image
 
-from . import compat #, signals
+from . import instrument #, signals
+from .utils import atomic_output, remove_output, Status
+
+#: Raised by Pillow when an image has more pixels than allowed.
+DECOMPRESSION_BOMB_ERRORS = tuple(
+    getattr(PILImage, name) for name in ('DecompressionBombError',
+                                         'DecompressionBombWarning')
+    if hasattr(PILImage, name))
+
+
+class ImageTooLargeError(Exception):
+    """Raised for an image with more pixels than SIGLICAN_MAX_IMAGE_PIXELS
+    allows, or that cannot be decoded within the memory budget."""
+
+
+def budget_pixel_limit(budget):
+    """Largest number of pixels that can be decoded within ``budget``
+    bytes: a JPEG shrunk by 8 while decoding, at 4 bytes per pixel, and one
+    copy of it (see :func:`estimate_memory`)."""
+    return budget * 8 * 8 // (4 * 2)
+
+
+def pixel_limit(settings):
+    """Return the largest number of pixels of the images siglican decodes.
+
+    This is SIGLICAN_MAX_IMAGE_PIXELS, 0 for no limit. None derives it from
+    SIGLICAN_MEMORY_BUDGET with :func:`budget_pixel_limit`, or keeps
+    Pillow's own limit (None) without a budget.
+    """
+    limit = settings['SIGLICAN_MAX_IMAGE_PIXELS']
+    if limit is None and settings['SIGLICAN_MEMORY_BUDGET']:
+        return budget_pixel_limit(settings['SIGLICAN_MEMORY_BUDGET'])
+    return limit
+
+
+# warnings.catch_warnings() swaps the filters of the whole process
+_warnings_lock = threading.Lock()
+
+
+def open_image(source, limit=None):
+    """Open ``source`` (a path or a file object) like PIL.Image.open, with a
+    limit of ``limit`` pixels instead of Pillow's.
+
+    Pillow's limit (PIL.Image.MAX_IMAGE_PIXELS) belongs to the process that
+    embeds siglican and is left alone: its warning is silenced for this open
+    only, and its error is bypassed when ``limit`` allows the image. None
+    keeps Pillow's limit and 0 disables it. Raises
+    :class:`ImageTooLargeError` for an image over ``limit``.
+    """
+    if limit is None:
+        return PILImage.open(source)
+    with _warnings_lock:
+        with warnings.catch_warnings():
+            if hasattr(PILImage, 'DecompressionBombWarning'):
+                warnings.simplefilter('ignore',
+                                      PILImage.DecompressionBombWarning)
+            try:
+                img = PILImage.open(source)
+            except DECOMPRESSION_BOMB_ERRORS:
+                img = None
+    if img is None:
+        # over twice Pillow's limit
+        img = _open_unchecked(source)
+    pixels = img.size[0] * img.size[1]
+    if limit and pixels > limit:
+        if not hasattr(source, 'read') and hasattr(img, 'close'):
+            img.close()
+        raise ImageTooLargeError(
+            'image of %dx%d pixels, more than %d'
+            % (img.size[0], img.size[1], limit))
+    return img
+
+
+def _open_unchecked(source):
+    """Open ``source`` with the format plugins of Pillow, as PIL.Image.open
+    does but without its pixel limit."""
+    exclusive = not hasattr(source, 'read')
+    fp = open(source, 'rb') if exclusive else source
+    fp.seek(0)
+    prefix = fp.read(16)
+    PILImage.init()
+    for fmt in PILImage.ID:
+        factory, accept = PILImage.OPEN[fmt]
+        accepted = not accept or accept(prefix)
+        if not accepted or isinstance(accepted, (bytes, str)):
+            continue  # a string explains why the format is rejected
+        fp.seek(0)
+        try:
+            img = factory(fp, source if exclusive else '')
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+        img._exclusive_fp = exclusive
+        return img
+    if exclusive:
+        fp.close()
+    raise IOError('cannot identify image file %r' % source)
+
 
 def _has_exif_tags(img):
     return hasattr(img, 'info') and 'exif' in img.info
 
 
-def generate_image(source, outname, settings, options=None):
+def _orientation_steps(img):
+    """Transpositions that the EXIF Orientation tag of ``img`` asks for."""
+    try:
+        return Transpose._EXIF_ORIENTATION_STEPS[img._getexif()[0x0112]]
+    except (IOError, IndexError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def _reduction(size, box):
+    """Largest power of two, up to 8, by which an image of ``size`` can be
+    shrunk and still cover ``box``."""
+    ratio = min(float(size[0]) / box[0], float(size[1]) / box[1])
+    factor = 1
+    while factor < 8 and factor * 2 <= ratio:
+        factor *= 2
+    return factor
+
+
+def estimate_memory(source, settings, limit=None, budget=None):
+    """Estimate the memory needed to resize ``source`` (a path or a file
+    object) from its header.
+
+    Returns ``(bytes, reduce)``. When resizing a JPEG at full size would
+    take more than ``limit`` bytes, ``reduce`` is the factor by which it is
+    shrunk while decoding, see :func:`generate_image`. Other formats are
+    always decoded at full size, and raise :class:`ImageTooLargeError` if
+    that takes more than the whole ``budget``. An image over
+    :func:`pixel_limit` is not estimated: :func:`generate_image` refuses it.
+    """
+    img = open_image(source, 0)
+    size, fmt = img.size, img.format
+    # Pillow keeps multi-band images at 4 bytes per pixel
+    depth = 1 if img.mode in ('1', 'L', 'P') else 4
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    elif hasattr(img, 'close'):
+        img.close()
+    pixels = pixel_limit(settings)
+    if pixels and size[0] * size[1] > pixels:
+        return 0, 1
+    full = size[0] * size[1] * depth
+    # the decoded image and one full-size copy (rotation)
+    if not limit or full * 2 <= limit:
+        return full * 2, 1
+    if fmt != 'JPEG':
+        if budget and full * 2 > budget:
+            raise ImageTooLargeError(
+                '%s image of %dx%d pixels needs %d MB at full size, more '
+                'than SIGLICAN_MEMORY_BUDGET' % (fmt, size[0], size[1],
+                                                 full * 2 >> 20))
+        return full * 2, 1
+    reduce = _reduction(size, settings['SIGLICAN_IMG_SIZE'])
+    return full // (reduce * reduce) * 2, reduce
+
+
+def _box_mean(a, size):
+    """Mean of every ``size`` x ``size`` window of the 2D array ``a``."""
+    import numpy
+    s = numpy.zeros((a.shape[0] + 1, a.shape[1] + 1))
+    s[1:, 1:] = a.cumsum(0).cumsum(1)
+    return (s[size:, size:] - s[:-size, size:] - s[size:, :-size] +
+            s[:-size, :-size]) / (size * size)
+
+
+def ssim(a, b, size=7):
+    """Mean structural similarity (SSIM) of the 2D arrays ``a`` and ``b``,
+    of 8 bit values, over ``size`` x ``size`` windows."""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mu_a, mu_b = _box_mean(a, size), _box_mean(b, size)
+    var_a = _box_mean(a * a, size) - mu_a * mu_a
+    var_b = _box_mean(b * b, size) - mu_b * mu_b
+    cov = _box_mean(a * b, size) - mu_a * mu_b
+    return float((((2 * mu_a * mu_b + c1) * (2 * cov + c2)) /
+                  ((mu_a * mu_a + mu_b * mu_b + c1) *
+                   (var_a + var_b + c2))).mean())
+
+
+def search_quality(img, target, quality_range=(60, 95), trials=6):
+    """Return the lowest JPEG quality of ``quality_range`` at which ``img``
+    keeps an SSIM of at least ``target`` (on the luminance), found by a
+    binary search of at most ``trials`` encodes done in memory. Returns the
+    top of the range if no trial reaches ``target``."""
+    import numpy
+    if min(img.size) < 7:
+        return quality_range[1]
+    reference = numpy.asarray(img.convert('L'), dtype=numpy.float64)
+    low, high = quality_range
+    best = high
+    for _ in range(trials):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        buf = io.BytesIO()
+        # optimize and progressive don't change the decoded pixels
+        save_image(img, buf, 'JPEG', options={'quality': quality},
+                   autoconvert=True)
+        decoded = PILImage.open(buf).convert('L')
+        score = ssim(reference, numpy.asarray(decoded, dtype=numpy.float64))
+        if score >= target:
+            best, high = quality, quality - 1
+        else:
+            low = quality + 1
+    return best
+
+
+def _target_quality(img, outformat, options, settings, qualities, key, name):
+    """Return ``options`` with the quality that reaches
+    SIGLICAN_JPG_TARGET_SSIM for ``img`` if it is saved as JPEG, taken from
+    or added to the ``qualities`` dict under ``key``."""
+    target = settings['SIGLICAN_JPG_TARGET_SSIM']
+    if not target or outformat != 'JPEG':
+        return options
+    quality = qualities.get(key) if qualities is not None else None
+    if quality is None:
+        try:
+            with instrument.stage('quality', name):
+                quality = search_quality(
+                    img, target, settings['SIGLICAN_JPG_QUALITY_RANGE'],
+                    settings['SIGLICAN_JPG_QUALITY_TRIALS'])
+        except ImportError:
+            logging.getLogger(__name__).warning(
+                'SIGLICAN_JPG_TARGET_SSIM needs NumPy, using the quality '
+                'of the options for %s', name)
+            return options
+        if qualities is not None:
+            qualities[key] = quality
+    options = dict(options or {})
+    options['quality'] = quality
+    return options
+
+
+def generate_image(source, outname, settings, options=None, reduce=1,
+                   fp=None, qualities=None):
     """Image processor, rotate and resize the image.
 
     :param source: path to an image
     :param outname: output filename
     :param settings: settings dict
     :param options: dict with PIL options (quality, optimize, progressive)
+    :param reduce: factor by which the image is shrunk before anything else,
+                   so that it never exists at full size when decoding can
+                   be scaled (JPEG)
+    :param fp: file object to read the image from instead of ``source``,
+               e.g. a buffer filled by :mod:`siglican.prefetch`
+    :param qualities: dict of the JPEG qualities already chosen for the
+                      source with SIGLICAN_JPG_TARGET_SSIM, updated with
+                      those chosen now
 
     """
 
     logger = logging.getLogger(__name__)
-    img = PILImage.open(source)
+    with instrument.stage('decode', source):
+        img = open_image(fp if fp is not None else source,
+                         pixel_limit(settings))
+        size = img.size
+        if reduce > 1 and img.format == 'JPEG':
+            # libjpeg decodes at 1/2, 1/4 or 1/8 of the size directly
+            img.draft(img.mode, (size[0] // reduce, size[1] // reduce))
+        img.load()
     original_format = img.format
 
     if settings['SIGLICAN_COPY_EXIF_DATA'] and settings['SIGLICAN_AUTOROTATE_IMAGES']:
@@ -80,25 +317,36 @@ def generate_image(source, outname, settings, options=None):
             options = {}
         options['exif'] = img.info['exif']
 
-    # Rotate the img, and catch IOError when PIL fails to read EXIF
-    if settings['SIGLICAN_AUTOROTATE_IMAGES']:
-        try:
-            img = Transpose().process(img)
-        except (IOError, IndexError):
-            pass
+    with instrument.stage('resize', source):
+        # read the orientation before a reduced copy drops the EXIF data
+        steps = []
+        if settings['SIGLICAN_AUTOROTATE_IMAGES']:
+            steps = _orientation_steps(img)
 
-    # Resize the image
-    if settings['SIGLICAN_IMG_PROCESSOR']:
-        try:
-            logger.debug('Processor: %s', settings['SIGLICAN_IMG_PROCESSOR'])
-            processor_cls = getattr(pilkit.processors,
-                                    settings['SIGLICAN_IMG_PROCESSOR'])
-        except AttributeError:
-            logger.error('Wrong processor name: %s', settings['SIGLICAN_IMG_PROCESSOR'])
-            sys.exit()
-
-        processor = processor_cls(*settings['SIGLICAN_IMG_SIZE'], upscale=False)
-        img = processor.process(img)
+        # a JPEG that draft() could not scale; other formats are never
+        # given a reduction, as they are already decoded at full size
+        if reduce > 1 and img.size == size and hasattr(img, 'reduce'):
+            try:
+                img = img.reduce(reduce)
+            except ValueError:
+                pass  # mode not supported by reduce()
+
+        # Rotate the img
+        if steps:
+            img = Transpose(*steps).process(img)
+
+        # Resize the image
+        if settings['SIGLICAN_IMG_PROCESSOR']:
+            try:
+                logger.debug('Processor: %s', settings['SIGLICAN_IMG_PROCESSOR'])
+                processor_cls = getattr(pilkit.processors,
+                                        settings['SIGLICAN_IMG_PROCESSOR'])
+            except AttributeError:
+                logger.error('Wrong processor name: %s', settings['SIGLICAN_IMG_PROCESSOR'])
+                sys.exit()
+
+            processor = processor_cls(*settings['SIGLICAN_IMG_SIZE'], upscale=False)
+            img = processor.process(img)
     
     # TODO ** delete (maintained from Sigal for reference)
     # signal.send() does not work here as plugins can modify the image, so we
@@ -107,29 +355,43 @@ def generate_image(source, outname, settings, options=None):
     #    img = receiver(img, settings=settings)
 
     outformat = img.format or original_format or 'JPEG'
+    options = _target_quality(img, outformat, options, settings, qualities,
+                              'resized', source)
     logger.debug(u'Save resized image to {0} ({1})'.format(outname, outformat))
-    save_image(img, outname, outformat, options=options, autoconvert=True)
+    with instrument.stage('encode', outname):
+        with atomic_output(outname) as tmp:
+            save_image(img, tmp, outformat, options=options, autoconvert=True)
 
 
-def generate_thumbnail(source, outname, box, fit=True, options=None):
-    """Create a thumbnail image."""
+def generate_thumbnail(source, outname, box, fit=True, options=None,
+                       settings=None, qualities=None):
+    """Create a thumbnail image. With ``settings``, its JPEG quality follows
+    SIGLICAN_JPG_TARGET_SSIM, see :func:`generate_image`."""
 
     logger = logging.getLogger(__name__)
-    img = PILImage.open(source)
-    original_format = img.format
+    with instrument.stage('thumbnail', outname):
+        img = PILImage.open(source)
+        original_format = img.format
 
-    if fit:
-        img = ImageOps.fit(img, box, PILImage.ANTIALIAS)
-    else:
-        img.thumbnail(box, PILImage.ANTIALIAS)
+        if fit:
+            img = ImageOps.fit(img, box, PILImage.ANTIALIAS)
+        else:
+            img.thumbnail(box, PILImage.ANTIALIAS)
 
-    outformat = img.format or original_format or 'JPEG'
-    logger.debug(u'Save thumnail image: {0} ({1})'.format(outname, outformat))
-    save_image(img, outname, outformat, options=options, autoconvert=True)
+        outformat = img.format or original_format or 'JPEG'
+        if settings is not None:
+            options = _target_quality(img, outformat, options, settings,
+                                      qualities, 'thumbnail', outname)
+        logger.debug(u'Save thumnail image: {0} ({1})'.format(outname, outformat))
+        with atomic_output(outname) as tmp:
+            save_image(img, tmp, outformat, options=options, autoconvert=True)
 
 
-def process_image(filepath, outpath, settings):
-    """Process one image: resize, create thumbnail."""
+def process_image(filepath, outpath, settings, reduce=1, fp=None,
+                  qualities=None):
+    """Process one image: resize, create thumbnail. Returns a
+    :class:`~siglican.utils.Status`. See :func:`generate_image` for
+    ``reduce``, ``fp`` and ``qualities``."""
 
     logger = logging.getLogger(__name__)
     filename = os.path.split(filepath)[1]
@@ -144,115 +406,28 @@ def process_image(filepath, outpath, settings):
         options = {}
 
     try:
-        generate_image(filepath, outname, settings, options=options)
+        generate_image(filepath, outname, settings, options=options,
+                       reduce=reduce, fp=fp, qualities=qualities)
+
+        if settings['SIGLICAN_MAKE_THUMBS']:
+            thumb_name = os.path.join(outpath, get_thumb(settings, filename))
+            generate_thumbnail(outname, thumb_name,
+                               settings['SIGLICAN_THUMB_SIZE'],
+                               fit=settings['SIGLICAN_THUMB_FIT'],
+                               options=options, settings=settings,
+                               qualities=qualities)
+    except (ImageTooLargeError,) + DECOMPRESSION_BOMB_ERRORS as e:
+        logger.error('Image %s is larger than SIGLICAN_MAX_IMAGE_PIXELS '
+                     'allows: %s', filepath, e)
+        return Status.FAILURE
     except Exception as e:
-        logger.error('Failed to process image: %s', e)
-        return
-
-    if settings['SIGLICAN_MAKE_THUMBS']:
-        thumb_name = os.path.join(outpath, get_thumb(settings, filename))
-        generate_thumbnail(outname, thumb_name, settings['SIGLICAN_THUMB_SIZE'],
-                           fit=settings['SIGLICAN_THUMB_FIT'], options=options)
-
-
-def _get_exif_data(filename):
-    """Return a dict with EXIF data."""
-
-    img = PILImage.open(filename)
-    exif = img._getexif() or {}
-    data = {TAGS.get(tag, tag): value for tag, value in exif.items()}
-
-    if 'GPSInfo' in data:
-        data['GPSInfo'] = {GPSTAGS.get(tag, tag): value
-                           for tag, value in data['GPSInfo'].items()}
-    return data
-
+        logger.error('Failed to process image %s: %s', filepath, e)
+        # don't leave a partial result that would pass for a processed image
+        remove_output(outname)
+        return Status.FAILURE
 
-def dms_to_degrees(v):
-    """Convert degree/minute/second to decimal degrees."""
+    return Status.SUCCESS
 
-    d = float(v[0][0]) / float(v[0][1])
-    m = float(v[1][0]) / float(v[1][1])
-    s = float(v[2][0]) / float(v[2][1])
-    return d + (m / 60.0) + (s / 3600.0)
-
-def get_exif_tags(source):
-    """Read EXIF tags from file @source and return a tuple of two dictionaries,
-    the first one containing the raw EXIF data, the second one a simplified
-    version with common tags.
-    """
-
-    logger = logging.getLogger(__name__)
-
-    if os.path.splitext(source)[1].lower() not in ('.jpg', '.jpeg'):
-        return (None, None)
-
-    try:
-        data = _get_exif_data(source)
-    except (IOError, IndexError, TypeError, AttributeError):
-        logger.warning(u'Could not read EXIF data from %s', source)
-        return (None, None)
-
-    simple = {}
-
-    # Provide more accessible tags in the 'simple' key
-    if 'FNumber' in data:
-        fnumber = data['FNumber']
-        simple['fstop'] = float(fnumber[0]) / fnumber[1]
-
-    if 'FocalLength' in data:
-        focal = data['FocalLength']
-        simple['focal'] = round(float(focal[0]) / focal[1])
-
-    if 'ExposureTime' in data:
-        if isinstance(data['ExposureTime'], tuple):
-            simple['exposure'] = '{0}/{1}'.format(*data['ExposureTime'])
-        elif isinstance(data['ExposureTime'], int):
-            simple['exposure'] = str(data['ExposureTime'])
-        else:
-            logger.warning('Unknown format for ExposureTime: %r (%s)',
-                           data['ExposureTime'], source)
-
-    if 'ISOSpeedRatings' in data:
-        simple['iso'] = data['ISOSpeedRatings']
-
-    if 'DateTimeOriginal' in data:
-        try:
-            # Remove null bytes at the end if necessary
-            date = data['DateTimeOriginal'].rsplit('\x00')[0]
-            simple['dateobj'] = datetime.strptime(date, '%Y:%m:%d %H:%M:%S')
-            dt = simple['dateobj'].strftime('%A, %d. %B %Y')
-
-            if compat.PY2:
-                simple['datetime'] = dt.decode('utf8')
-            else:
-                simple['datetime'] = dt
-        except (ValueError, TypeError) as e:
-            logger.warning(u'Could not parse DateTimeOriginal of %s: %s',
-                           source, e)
-
-    if 'GPSInfo' in data:
-        info = data['GPSInfo']
-        lat_info = info.get('GPSLatitude')
-        lon_info = info.get('GPSLongitude')
-        lat_ref_info = info.get('GPSLatitudeRef')
-        lon_ref_info = info.get('GPSLongitudeRef')
-
-        if lat_info and lon_info and lat_ref_info and lon_ref_info:
-            try:
-                lat = dms_to_degrees(lat_info)
-                lon = dms_to_degrees(lon_info)
-            except (ZeroDivisionError, ValueError):
-                logger.warning('Failed to read GPS info for %s', source)
-                lat = lon = None
-
-            if lat and lon:
-                simple['gps'] = {
-                    'lat': - lat if lat_ref_info != 'N' else lat,
-                    'lon': - lon if lon_ref_info != 'E' else lon,
-                }
-
-    return (data, simple)
 
 def get_thumb(settings, filename):
     """Return the path to the thumb.
@@ -0,0 +1,301 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Per-stage timing and resource accounting for the build report, Chrome
+# trace-event spans and per-phase cProfile dumps.
+#
+# Code on the hot path wraps its work in ``with instrument.stage(name, path):``.
+# While neither a report nor a trace is active this returns a shared no-op
+# context manager. Stages nest; each one is accounted inclusively.
+
+import json
+import heapq
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from . import compat
+from .pkgmeta import __version__
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_wall = getattr(time, 'perf_counter', time.time)
+_cpu = (getattr(time, 'thread_time', None) or
+        getattr(time, 'process_time', None) or time.clock)
+
+# the active BuildReport, Tracer and profile directory, if any
+_report = None
+_tracer = None
+_profile_dir = None
+_profiling = False
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+def _io_counters():
+    """Bytes read and written by this process so far (Linux only)."""
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            lines = f.read().split(b'\n')
+    except (IOError, OSError):
+        return 0, 0
+    counters = dict(l.split(b': ') for l in lines if b': ' in l)
+    return int(counters.get(b'rchar', 0)), int(counters.get(b'wchar', 0))
+
+
+def _children_cpu():
+    """CPU time of the waited-for child processes (ffmpeg)."""
+    t = os.times()
+    return t[2] + t[3]
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class _Stage(object):
+    __slots__ = ('report', 'tracer', 'name', 'path', 'start')
+
+    def __init__(self, report, tracer, name, path):
+        self.report = report
+        self.tracer = tracer
+        self.name = name
+        self.path = path
+
+    def __enter__(self):
+        if self.report is not None:
+            rchar, wchar = _io_counters()
+            self.start = (_wall(), _cpu(), _children_cpu(), rchar, wchar,
+                          peak_rss())
+        else:
+            self.start = (_wall(),)
+        return self
+
+    def __exit__(self, *exc):
+        end = _wall()
+        if self.report is not None:
+            rchar, wchar = _io_counters()
+            wall, cpu, children, read, written, rss = self.start
+            growth = None if rss is None else peak_rss() - rss
+            self.report.add(self.name, self.path, end - wall,
+                            _cpu() - cpu + _children_cpu() - children,
+                            rchar - read, wchar - written, growth)
+        if self.tracer is not None:
+            self.tracer.add(self.name, self.path, self.start[0], end)
+        return False
+
+
+class BuildReport(object):
+    """Aggregated wall time, CPU time, I/O and peak RSS growth per build
+    stage, and the peak RSS of the process.
+
+    CPU time is that of the calling thread plus its child processes; bytes
+    read and written are process-wide, so stages running concurrently with
+    the ZIP archiver include some of its I/O. The peak RSS growth of a stage
+    is the most any of its runs raised the peak RSS of the process, which is
+    0 for stages that stay below an earlier peak.
+    """
+
+    def __init__(self, slowest=10):
+        self.slowest_count = slowest
+        self.started = time.time()
+        self.stages = defaultdict(lambda: {'count': 0, 'wall': 0.0,
+                                           'cpu': 0.0, 'read_bytes': 0,
+                                           'written_bytes': 0,
+                                           'peak_rss_growth': None})
+        self.slowest = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, name, path, wall, cpu, read, written, rss_growth=None):
+        with self._lock:
+            s = self.stages[name]
+            s['count'] += 1
+            s['wall'] += wall
+            s['cpu'] += cpu
+            s['read_bytes'] += read
+            s['written_bytes'] += written
+            if rss_growth is not None:
+                s['peak_rss_growth'] = max(s['peak_rss_growth'] or 0,
+                                           rss_growth)
+            if path is not None and self.slowest_count:
+                heap = self.slowest[name]
+                item = (wall, path)
+                if len(heap) < self.slowest_count:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+    def as_dict(self):
+        with self._lock:
+            stages = dict((k, dict(v)) for k, v in self.stages.items())
+            slowest = dict((k, [{'path': p, 'wall': w}
+                                for w, p in sorted(v, reverse=True)])
+                           for k, v in self.slowest.items())
+        for s in stages.values():
+            if s['wall'] > 0:
+                s['files_per_second'] = s['count'] / s['wall']
+        return {
+            'version': __version__,
+            'started': self.started,
+            'duration': time.time() - self.started,
+            'peak_rss': peak_rss(),
+            'stages': stages,
+            'slowest': slowest,
+        }
+
+    def write(self, path, **extra):
+        """Write the report as JSON to ``path`` with ``extra`` top-level keys."""
+        data = self.as_dict()
+        data.update(extra)
+        dirname = os.path.dirname(path)
+        if dirname:
+            compat.makedirs(dirname)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True, default=str)
+        compat.replace(tmp_path, path)
+        logger.info("siglican: build report written to %s", path)
+
+
+class Tracer(object):
+    """Collects stages as Chrome trace events, viewable in Perfetto or
+    chrome://tracing."""
+
+    def __init__(self, path):
+        self.path = path
+        self.origin = _wall()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, path, start, end):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': 'siglican', 'ph': 'X',
+                 'ts': (start - self.origin) * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': self.pid, 'tid': thread.ident}
+        if path is not None:
+            event['args'] = {'path': path}
+        with self._lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def write(self):
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                   'tid': tid, 'args': {'name': name}}
+                  for tid, name in self.threads.items()]
+        events.extend(self.events)
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            compat.makedirs(dirname)
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        logger.info("siglican: trace written to %s", self.path)
+
+
+def start(report=True, slowest=10, trace=None, profile=None):
+    """Start collecting a new build report unless ``report`` is false, a
+    trace written to the path ``trace`` and cProfile dumps of each phase in
+    the directory ``profile``. Returns the report."""
+    global _report, _tracer, _profile_dir
+    _report = BuildReport(slowest) if report else None
+    _tracer = Tracer(trace) if trace else None
+    _profile_dir = profile or None
+    return _report
+
+
+def finish():
+    """Stop collecting, write the trace and return the report, or None if
+    none was active."""
+    global _report, _tracer, _profile_dir
+    report, tracer = _report, _tracer
+    _report = _tracer = _profile_dir = None
+    if tracer is not None:
+        try:
+            tracer.write()
+        except (IOError, OSError) as e:
+            logger.error("siglican: could not write trace: %s", e)
+    return report
+
+
+def stage(name, path=None):
+    """Context manager accounting the enclosed block to stage ``name``;
+    ``path`` names the file being worked on for the slowest-N lists."""
+    report, tracer = _report, _tracer
+    if report is None and tracer is None:
+        return _NULL_STAGE
+    return _Stage(report, tracer, name, path)
+
+
+def phase(name):
+    """Decorator running a build phase as stage ``name`` and, when profiling
+    is enabled, under cProfile, dumped to ``<profile dir>/<name>.pstats``."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            global _profiling
+            # a phase nested in a profiled one is part of the outer profile
+            if _profile_dir is None or _profiling:
+                with stage(name):
+                    return func(*args, **kwargs)
+            import cProfile
+            profile_dir = _profile_dir
+            profiler = cProfile.Profile()
+            with stage(name):
+                _profiling = True
+                profiler.enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    _profiling = False
+                    compat.makedirs(profile_dir)
+                    dump = os.path.join(profile_dir, name + '.pstats')
+                    profiler.dump_stats(dump)
+                    logger.info("siglican: profile of %s written to %s",
+                                name, dump)
+        return wrapper
+    return decorator
@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Read-ahead of source files for slow (network) storage.
+
+While a worker decodes one image, a :class:`Prefetcher` thread reads the
+next ones into memory, so that reading and decoding overlap. Files that are
+not decoded by siglican itself (videos, handed to ffmpeg) or too large for
+the prefetch memory only get an OS read-ahead hint.
+"""
+
+import io
+import logging
+import os
+import threading
+import time
+
+from . import instrument
+
+logger = logging.getLogger(__name__)
+
+
+def readahead_hint(path):
+    """Ask the OS to start reading ``path`` into its page cache. Returns
+    False where hints are not supported."""
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None:
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+class Prefetcher(object):
+    """Read the files of ``items``, ``(path, buffered)`` pairs in the order
+    they will be used, in a background thread.
+
+    At most ``depth`` files, taking at most ``max_bytes`` together, are held
+    in memory until :meth:`take` hands them out. Files with ``buffered``
+    false, or larger than ``max_bytes``, only get a read-ahead hint. Every
+    path must be taken once, by any thread, in roughly the given order.
+    """
+
+    def __init__(self, items, depth, max_bytes):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.stats = {'prefetch_hits': 0, 'prefetch_misses': 0,
+                      'prefetch_bytes': 0, 'prefetch_hints': 0,
+                      'prefetch_wait': 0.0}
+        self._items = list(items)
+        self._buffers = {}
+        self._used = 0
+        self._reading = None
+        self._taken = set()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='siglican-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        for path, buffered in self._items:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if not buffered or size > self.max_bytes:
+                if readahead_hint(path):
+                    with self._cond:
+                        self.stats['prefetch_hints'] += 1
+                continue
+            with self._cond:
+                while not self._closed and self._buffers and (
+                        len(self._buffers) >= self.depth or
+                        self._used + size > self.max_bytes):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                if path in self._taken:
+                    continue  # its consumer did not wait for us
+                self._reading = path
+            try:
+                with instrument.stage('prefetch', path):
+                    with open(path, 'rb') as f:
+                        data = f.read()
+            except (IOError, OSError) as e:
+                logger.debug("siglican: could not prefetch %s: %s", path, e)
+                data = None
+            with self._cond:
+                self._reading = None
+                if data is not None and path not in self._taken:
+                    self._buffers[path] = data
+                    self._used += len(data)
+                    self.stats['prefetch_bytes'] += len(data)
+                self._cond.notify_all()
+
+    def take(self, path):
+        """Return a file object holding the content of ``path`` if it was
+        read ahead (waiting if it is being read), or None."""
+        with self._cond:
+            self._taken.add(path)
+            if self._reading == path:
+                started = time.time()
+                while self._reading == path:
+                    self._cond.wait()
+                self.stats['prefetch_wait'] += time.time() - started
+            data = self._buffers.pop(path, None)
+            if data is None:
+                self.stats['prefetch_misses'] += 1
+                return None
+            self._used -= len(data)
+            self.stats['prefetch_hits'] += 1
+            self._cond.notify_all()
+        return io.BytesIO(data)
+
+    def close(self):
+        """Stop reading ahead and drop the buffers not taken."""
+        with self._cond:
+            self._closed = True
+            self._buffers.clear()
+            self._used = 0
+            self._cond.notify_all()
+        self._thread.join()
@@ -0,0 +1,321 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Publishing of the gallery output to a web server or object storage.
+
+Every file a build writes or removes below SIGLICAN_DESTINATION is added to
+a :class:`~siglican.cache.ChangeSet`. :func:`publish` sends only those
+files to the target: it uploads the ones that exist and deletes the others,
+without listing or hashing the rest of the tree. The first publish to a
+target, or one after the target changed, sends everything instead and
+deletes what the target holds beyond the output.
+
+Targets are a local directory or a ``scheme://...`` URL handled by the
+backend registered for the scheme in :data:`BACKENDS`.
+"""
+
+import logging
+import mimetypes
+import os
+import threading
+
+from . import compat, instrument
+from .assets import is_fingerprinted
+from .cache import ChangeSet
+from .utils import place_file, PLACEMENT_STRATEGIES
+
+logger = logging.getLogger(__name__)
+
+# missing from the mimetypes tables of some platforms
+_CONTENT_TYPES = {
+    '.webm': 'video/webm',
+    '.ogv': 'video/ogg',
+    '.mp4': 'video/mp4',
+    '.js': 'application/javascript',
+    '.css': 'text/css',
+}
+
+
+def content_type(relpath):
+    """Return the MIME type to serve ``relpath`` with."""
+    ext = os.path.splitext(relpath)[1].lower()
+    if ext in _CONTENT_TYPES:
+        return _CONTENT_TYPES[ext]
+    return mimetypes.guess_type(relpath)[0] or 'application/octet-stream'
+
+
+def cache_control(relpath, settings):
+    """Return the Cache-Control header to serve ``relpath`` with, from
+    SIGLICAN_PUBLISH_CACHE_CONTROL, or None. Asset bundles, whose name
+    changes with their content, use the ``'bundle'`` rule."""
+    rules = settings['SIGLICAN_PUBLISH_CACHE_CONTROL']
+    if is_fingerprinted(relpath) and 'bundle' in rules:
+        return rules['bundle']
+    ext = os.path.splitext(relpath)[1].lower()
+    return rules.get(ext, rules.get('*'))
+
+
+class LocalBackend(object):
+    """Publish to the directory ``target``, e.g. the document root of a web
+    server. Headers are left to the server."""
+
+    def __init__(self, target, settings):
+        self.root = os.path.abspath(os.path.expanduser(target))
+
+    def list(self):
+        relpaths = []
+        for path, dirs, files in os.walk(self.root):
+            for f in files:
+                relpath = os.path.relpath(os.path.join(path, f), self.root)
+                relpaths.append(relpath.replace(os.sep, '/'))
+        return relpaths
+
+    def upload(self, relpath, path, headers):
+        dst = os.path.join(self.root, *relpath.split('/'))
+        compat.makedirs(os.path.dirname(dst))
+        # a reflink or hardlink publishes without copying where possible
+        place_file(path, dst, PLACEMENT_STRATEGIES)
+
+    def delete(self, relpaths):
+        """Remove ``relpaths``, returning those that could not be."""
+        failed = []
+        for relpath in relpaths:
+            path = os.path.join(self.root, *relpath.split('/'))
+            try:
+                if os.path.lexists(path):
+                    os.remove(path)
+            except OSError as e:
+                logger.error("siglican: could not delete %s: %s", path, e)
+                failed.append(relpath)
+        return failed
+
+    def close(self):
+        pass
+
+
+class S3Backend(object):
+    """Publish to ``s3://bucket/prefix`` on Amazon S3 or any S3 compatible
+    service (SIGLICAN_PUBLISH_ENDPOINT), with boto3.
+
+    Credentials and region come from boto3's usual sources (environment,
+    ``~/.aws``). A single client, whose connection pool is as large as the
+    number of workers, is shared by all uploads.
+    """
+
+    # maximum number of keys of a DeleteObjects request
+    delete_batch = 1000
+
+    def __init__(self, target, settings):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise SystemExit('siglican: publishing to %s needs boto3 '
+                             '(pip install boto3)' % target)
+        self.bucket, _, prefix = target[len('s3://'):].partition('/')
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        config = Config(
+            max_pool_connections=settings['SIGLICAN_PUBLISH_WORKERS'])
+        self.client = boto3.session.Session().client(
+            's3', endpoint_url=settings['SIGLICAN_PUBLISH_ENDPOINT'],
+            config=config)
+
+    def list(self):
+        relpaths = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket,
+                                       Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                relpaths.append(item['Key'][len(self.prefix):])
+        return relpaths
+
+    def upload(self, relpath, path, headers):
+        with open(path, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket,
+                                   Key=self.prefix + relpath, Body=f,
+                                   **headers)
+
+    def delete(self, relpaths):
+        """Delete ``relpaths``, returning those that could not be."""
+        failed = []
+        for i in range(0, len(relpaths), self.delete_batch):
+            batch = relpaths[i:i + self.delete_batch]
+            objects = [{'Key': self.prefix + relpath} for relpath in batch]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': objects, 'Quiet': True})
+            except Exception as e:
+                logger.error("siglican: could not delete %d objects: %s",
+                             len(batch), e)
+                failed.extend(batch)
+                continue
+            for error in response.get('Errors', []):
+                logger.error("siglican: could not delete %s: %s",
+                             error['Key'], error.get('Message'))
+                failed.append(error['Key'][len(self.prefix):])
+        return failed
+
+    def close(self):
+        pass
+
+
+#: Backend class of each target URL scheme. A backend is created with the
+#: target and the settings and has ``list()``, ``upload(relpath, path,
+#: headers)``, ``delete(relpaths)`` returning the failed ones, and
+#: ``close()``. Targets without a scheme are local directories.
+BACKENDS = {
+    'file': LocalBackend,
+    's3': S3Backend,
+}
+
+
+def get_backend(target, settings):
+    scheme, sep, rest = target.partition('://')
+    if not sep:
+        return LocalBackend(target, settings)
+    if scheme not in BACKENDS:
+        raise SystemExit('siglican: no publish backend for %s' % target)
+    if scheme == 'file':
+        target = rest
+    return BACKENDS[scheme](target, settings)
+
+
+def _output_files(root):
+    relpaths = []
+    for path, dirs, files in os.walk(root):
+        for f in files:
+            # temporary files of a concurrent build (atomic_output)
+            if f.startswith('.') and '.tmp' in f:
+                continue
+            relpath = os.path.relpath(os.path.join(path, f), root)
+            relpaths.append(relpath.replace(os.sep, '/'))
+    return relpaths
+
+
+def plan(settings, target=None):
+    """Return ``(uploads, deletes, changes, backend)``: the relative paths
+    that publishing the output to ``target`` (by default SIGLICAN_PUBLISH)
+    uploads and deletes, the change set they come from, and the backend if
+    it had to be created to list the target."""
+    target = target or settings['SIGLICAN_PUBLISH']
+    root = settings['SIGLICAN_DESTINATION']
+    changes = ChangeSet(settings['SIGLICAN_CACHE_PATH'])
+    if changes.target == target:
+        relpaths = sorted(changes.pending)
+        uploads = [r for r in relpaths
+                   if os.path.isfile(os.path.join(root, *r.split('/')))]
+        deletes = sorted(set(relpaths) - set(uploads))
+        return uploads, deletes, changes, None
+    # not published to this target yet: compare with what it holds
+    logger.warning("siglican: first publish to %s, sending the whole "
+                   "output", target)
+    backend = get_backend(target, settings)
+    uploads = sorted(_output_files(root))
+    deletes = sorted(set(backend.list()) - set(uploads))
+    return uploads, deletes, changes, backend
+
+
+def publish(settings, target=None, dry_run=False):
+    """Send the changes of the output since the last publish to ``target``
+    (by default SIGLICAN_PUBLISH) with SIGLICAN_PUBLISH_WORKERS threads.
+
+    Files that fail stay in the change set for the next publish. With
+    ``dry_run``, only logs what would be sent. Returns stats.
+    """
+    target = target or settings['SIGLICAN_PUBLISH']
+    root = settings['SIGLICAN_DESTINATION']
+    uploads, deletes, changes, backend = plan(settings, target)
+    stats = {'published': 0, 'published_bytes': 0, 'unpublished': 0,
+             'publish_failed': 0}
+    if dry_run:
+        for relpath in uploads:
+            logger.warning("siglican: would upload %s", relpath)
+        for relpath in deletes:
+            logger.warning("siglican: would delete %s", relpath)
+        return stats
+    if not uploads and not deletes:
+        if changes.target != target:
+            changes.published(target)
+            changes.save()
+        return stats
+    if backend is None:
+        backend = get_backend(target, settings)
+
+    queue = iter(uploads)
+    lock = threading.Lock()
+    failed = []
+
+    def upload(relpath):
+        path = os.path.join(root, *relpath.split('/'))
+        headers = {'ContentType': content_type(relpath)}
+        control = cache_control(relpath, settings)
+        if control:
+            headers['CacheControl'] = control
+        try:
+            with instrument.stage('upload', relpath):
+                backend.upload(relpath, path, headers)
+            size = os.path.getsize(path)
+        except Exception as e:
+            logger.error("siglican: could not upload %s: %s", relpath, e)
+            with lock:
+                failed.append(relpath)
+            return
+        with lock:
+            stats['published'] += 1
+            stats['published_bytes'] += size
+
+    def work():
+        while True:
+            with lock:
+                relpath = next(queue, None)
+            if relpath is None:
+                return
+            upload(relpath)
+
+    try:
+        workers = min(settings['SIGLICAN_PUBLISH_WORKERS'], len(uploads))
+        threads = [threading.Thread(target=work,
+                                    name='siglican-publish-%d' % i)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if deletes:
+            with instrument.stage('delete', target):
+                not_deleted = backend.delete(deletes)
+            failed.extend(not_deleted)
+            stats['unpublished'] = len(deletes) - len(not_deleted)
+    finally:
+        backend.close()
+    stats['publish_failed'] = len(failed)
+    changes.published(target, failed)
+    changes.save()
+    logger.info("siglican: published %d files (%d bytes) and deleted %d "
+                "from %s", stats['published'], stats['published_bytes'],
+                stats['unpublished'], target)
+    if failed:
+        logger.warning("siglican: %d files could not be published, they are "
+                       "retried by the next publish", len(failed))
+    return stats
@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Development server generating derivatives on demand.
+
+Album pages link to resized media and thumbnails that a build would create.
+:func:`serve` serves a directory over HTTP and, when a requested file is one
+of these derivatives and does not exist yet, creates it with the regular
+processing (see :meth:`siglican.gallery.Gallery.generate`) before answering.
+Generated files land in the normal output directory and are recorded in the
+build journal, so a later build skips them.
+"""
+
+import logging
+import os
+
+from .compat import PY2
+
+# not in compat.py, which every module imports: the HTTP modules are only
+# needed by the server
+if not PY2:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer  # NOQA
+    from SimpleHTTPServer import SimpleHTTPRequestHandler  # NOQA
+    from SocketServer import ThreadingMixIn  # NOQA
+
+logger = logging.getLogger(__name__)
+
+
+class GalleryRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files below ``server.root``, generating missing derivatives of
+    ``server.gallery`` first."""
+
+    def translate_path(self, path):
+        # SimpleHTTPRequestHandler serves the working directory
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.root,
+                            os.path.relpath(path, os.getcwd()))
+
+    def _generate(self):
+        path = self.translate_path(self.path)
+        if not os.path.exists(path):
+            try:
+                if self.server.gallery.generate(path):
+                    logger.info("siglican: generated %s", path)
+            except Exception as e:
+                logger.error("siglican: could not generate %s: %s", path, e)
+
+    def do_GET(self):
+        self._generate()
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def do_HEAD(self):
+        self._generate()
+        SimpleHTTPRequestHandler.do_HEAD(self)
+
+    def log_message(self, format, *args):
+        logger.debug("siglican: %s - %s", self.address_string(),
+                     format % args)
+
+
+class GalleryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, gallery, root):
+        HTTPServer.__init__(self, address, GalleryRequestHandler)
+        self.gallery = gallery
+        self.root = os.path.abspath(root)
+
+
+def serve(gallery, root, bind='127.0.0.1', port=8000):
+    """Serve ``root`` until interrupted, generating the missing derivatives
+    of ``gallery`` on request."""
+    server = GalleryServer((bind, port), gallery, root)
+    gallery.open_state()
+    logger.warning("siglican: serving %s at http://%s:%d/, press Ctrl-C to "
+                   "stop", root, bind, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        gallery.close_state()
@@ -0,0 +1,187 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Per-album thumbnail sprite sheets. Sheets are built by the generator from
+# the thumbnails once the media of an album are processed, and their layout
+# is kept in a SpriteIndex (see cache.py); templates get the position of
+# each thumbnail from Media.sprite.
+
+import hashlib
+import logging
+import math
+import os
+from collections import namedtuple
+
+from .utils import atomic_output, remove_output, url_from_path
+
+#: Position of a thumbnail in a sprite sheet: ``url`` of the sheet, relative
+#: to the album directory, and the box of the thumbnail in it, in pixels.
+Sprite = namedtuple('Sprite', ['url', 'x', 'y', 'width', 'height'])
+
+
+def sprite_members(album, settings):
+    """Return the ``(media, thumb_path)`` pairs of the thumbnails of
+    ``album`` that exist, in album order."""
+
+    if not settings['SIGLICAN_MAKE_THUMBS']:
+        return []
+    return [(media, media.thumb_path) for media in album.medias
+            if os.path.isfile(media.thumb_path)]
+
+
+def sprite_signature(members, settings):
+    """Digest of the names, sizes and mtimes of the thumbnails and of the
+    settings the sheets depend on."""
+
+    h = hashlib.sha1(repr((settings['SIGLICAN_THUMB_SPRITE_COUNT'],
+                           settings['SIGLICAN_JPG_OPTIONS'])).encode('utf-8'))
+    for media, path in members:
+        st = os.stat(path)
+        h.update(('%s\0%d\0%d\n' % (media.thumb_name, st.st_size,
+                                    int(st.st_mtime))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _chunks(members, count):
+    if not count:
+        return [members]
+    return [members[i:i + count] for i in range(0, len(members), count)]
+
+
+def _pack(thumbs, png=False):
+    """Pack the ``(name, image)`` pairs of ``thumbs`` on a grid of cells as
+    large as the largest thumbnail. Returns the sheet and the ``name: [x,
+    y, width, height]`` offsets."""
+
+    from PIL import Image as PILImage
+    cell_w = max(img.size[0] for name, img in thumbs)
+    cell_h = max(img.size[1] for name, img in thumbs)
+    columns = int(math.ceil(math.sqrt(len(thumbs))))
+    rows = int(math.ceil(len(thumbs) / float(columns)))
+    sheet = PILImage.new('RGBA' if png else 'RGB',
+                         (columns * cell_w, rows * cell_h),
+                         (0, 0, 0, 0) if png else (255, 255, 255))
+    offsets = {}
+    for i, (name, img) in enumerate(thumbs):
+        x, y = (i % columns) * cell_w, (i // columns) * cell_h
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if png else 'RGB')
+        sheet.paste(img, (x, y), img if img.mode == 'RGBA' else None)
+        offsets[name] = [x, y, img.size[0], img.size[1]]
+    return sheet, offsets
+
+
+def _is_current(album, entry, signature):
+    """Whether the sheets of index ``entry`` were packed from thumbnails
+    with ``signature`` and are all in the output."""
+    return entry is not None and entry['signature'] == signature and all(
+        os.path.isfile(os.path.join(album.dst_path, sheet))
+        for sheet in entry['sheets'])
+
+
+def read_sprites(album, settings, index):
+    """Set the :class:`Sprite` of the media of ``album`` from the sheets
+    that ``index`` holds for it, without writing any, for pages written
+    without processing the media. Media get none if the sheets no longer
+    match the thumbnails. Returns True if they do."""
+
+    members = sprite_members(album, settings)
+    entry = index.get(album.path)
+    current = bool(members) and _is_current(
+        album, entry, sprite_signature(members, settings))
+    set_sprites(album, entry if current else None)
+    return current
+
+
+def write_sprites(album, settings, index):
+    """Write the sprite sheets of ``album`` unless they are up to date, and
+    set the :class:`Sprite` of its media.
+
+    ``index`` is the :class:`~siglican.cache.SpriteIndex` holding the layout
+    of the sheets of the previous build. Albums get one sheet for every
+    SIGLICAN_THUMB_SPRITE_COUNT thumbnails (or a single one if it is 0),
+    named ``sprite-<n>.jpg`` in SIGLICAN_THUMB_DIR, or ``.png`` if a
+    thumbnail is a PNG. Returns True if the sheets were (re)written.
+    """
+
+    logger = logging.getLogger(__name__)
+    members = sprite_members(album, settings)
+    entry = index.get(album.path)
+    signature = sprite_signature(members, settings) if members else None
+    if _is_current(album, entry, signature):
+        logger.debug('siglican: sprite sheets of %r are up to date', album)
+        set_sprites(album, entry)
+        return False
+
+    new = None
+    if members:
+        from PIL import Image as PILImage
+        from pilkit.utils import save_image
+        png = any(os.path.splitext(path)[1].lower() == '.png'
+                  for media, path in members)
+        ext = 'png' if png else 'jpg'
+        new = {'signature': signature, 'sheets': [], 'offsets': {}}
+        for n, chunk in enumerate(
+                _chunks(members, settings['SIGLICAN_THUMB_SPRITE_COUNT'])):
+            sheet_name = os.path.join(settings['SIGLICAN_THUMB_DIR'],
+                                      'sprite-%d.%s' % (n + 1, ext))
+            sheet_path = os.path.join(album.dst_path, sheet_name)
+            thumbs = []
+            for media, path in chunk:
+                img = PILImage.open(path)
+                img.load()
+                thumbs.append((media.filename, img))
+            sheet, offsets = _pack(thumbs, png)
+            with atomic_output(sheet_path) as tmp:
+                save_image(sheet, tmp, 'PNG' if png else 'JPEG',
+                           options=(None if png else
+                                    settings['SIGLICAN_JPG_OPTIONS']))
+            for name, box in offsets.items():
+                new['offsets'][name] = [len(new['sheets'])] + box
+            new['sheets'].append(sheet_name)
+        logger.debug('siglican: wrote %d sprite sheets for %r',
+                     len(new['sheets']), album)
+
+    # sheets of the previous layout that are left over
+    if entry is not None:
+        for sheet in set(entry['sheets']) - set(new['sheets'] if new else ()):
+            remove_output(os.path.join(album.dst_path, sheet))
+    if new is None:
+        index.discard(album.path)
+    else:
+        index.set(album.path, new)
+    set_sprites(album, new)
+    return new is not None
+
+
+def set_sprites(album, entry):
+    """Set the :class:`Sprite` of the media of ``album`` from its index
+    ``entry`` (None for none)."""
+
+    offsets = entry['offsets'] if entry else {}
+    sheets = entry['sheets'] if entry else []
+    for media in album.medias:
+        box = offsets.get(media.filename)
+        if box is None:
+            media.sprite = None
+        else:
+            media.sprite = Sprite(url_from_path(sheets[box[0]]), *box[1:])
@@ -21,22 +21,203 @@
 # IN THE SOFTWARE.
 
 import codecs
+import hashlib
+import logging
 import os
 import shutil
-from markdown import Markdown
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from subprocess import Popen, PIPE
 
-from . import compat
+from . import compat, instrument
 
 #### TODO: split up/delete these functions.
 
-# TODO: delete
-def copy(src, dst, symlink=False):
+class Status(object):
+    """Result of processing a media."""
+    SUCCESS = 0
+    FAILURE = 1
+
+
+class MemoryBudget(object):
+    """Admit jobs while the sum of their estimated memory use stays within
+    ``limit`` bytes. A job larger than the whole budget runs alone. A
+    ``limit`` of None or 0 admits every job at once."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount):
+        """Context manager blocking until ``amount`` bytes are available
+        and holding them for the duration of the block."""
+        if not self.limit:
+            yield
+            return
+        amount = min(amount, self.limit)
+        with self._cond:
+            while self.used and self.used + amount > self.limit:
+                self._cond.wait()
+            self.used += amount
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= amount
+                self._cond.notify_all()
+
+
+#: Ways of putting a source file in the output tree, cheapest first. Outputs
+#: may share storage with their source, so they must never be modified in
+#: place; they are only ever replaced.
+PLACEMENT_STRATEGIES = ('reflink', 'hardlink', 'copy_file_range', 'copy')
+
+#: Number of files placed with each strategy since the last reset.
+placement_counts = defaultdict(int)
+
+#: Absolute paths of the files written by :func:`atomic_output` or removed by
+#: :func:`remove_output` since the last reset, i.e. what a publish must send.
+changed_paths = set()
+
+# linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(src, dst):
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is None and not hasattr(os, 'sendfile'):
+        raise OSError('copy_file_range and sendfile are unavailable')
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                if copy_range is not None:
+                    sent = copy_range(fsrc.fileno(), fdst.fileno(), remaining)
+                else:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset,
+                                       remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+    shutil.copystat(src, dst)
+
+
+_PLACERS = {
+    'symlink': os.symlink if hasattr(os, 'symlink') else None,
+    'reflink': _reflink,
+    'hardlink': os.link if hasattr(os, 'link') else None,
+    'copy_file_range': _copy_file_range,
+    'copy': shutil.copy2,
+}
+
+
+def place_file(src, dst, strategies=PLACEMENT_STRATEGIES):
+    """Make ``dst`` hold the content of ``src`` using the first strategy of
+    ``strategies`` that works on this platform and filesystem.
+
+    Strategies are the names in ``PLACEMENT_STRATEGIES`` and ``'symlink'``.
+    A plain copy is the last resort even if it is not listed. Returns the
+    name of the strategy that was used.
+    """
+    logger = logging.getLogger(__name__)
+    strategies = [s for s in strategies if _PLACERS.get(s) is not None]
+    if 'copy' not in strategies:
+        strategies.append('copy')
+
+    for strategy in strategies:
+        try:
+            with atomic_output(dst) as tmp:
+                _PLACERS[strategy](src, tmp)
+        except (IOError, OSError) as e:
+            logger.debug('Could not %s %s: %s', strategy, src, e)
+            continue
+        logger.debug('Placed %s at %s (%s)', src, dst, strategy)
+        placement_counts[strategy] += 1
+        return strategy
+    raise IOError('Could not place %s at %s' % (src, dst))
+
+
+@contextmanager
+def atomic_output(path):
+    """Context manager yielding a temporary path to write ``path`` to.
+
+    The temporary file is renamed to ``path`` when the block succeeds and
+    removed when it fails, so an interrupted build never leaves a truncated
+    output behind. It keeps the extension of ``path`` for tools that infer the
+    format from it (ffmpeg).
+    """
+    dirname, name = os.path.split(path)
+    base, ext = os.path.splitext(name)
+    tmp = os.path.join(dirname, '.%s.%d.tmp%s' % (base, os.getpid(), ext))
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    compat.replace(tmp, path)
+    # rename() is a no-op when both names are links to the same file
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    changed_paths.add(os.path.abspath(path))
+
+
+def remove_output(path):
+    """Remove the output file ``path`` if it exists."""
+    if os.path.lexists(path):
+        os.remove(path)
+        changed_paths.add(os.path.abspath(path))
+
+
+def _is_placed(src, dst):
+    """Whether ``dst`` already holds a placed copy of ``src``."""
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        st_src, st_dst = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return (st_src.st_size == st_dst.st_size and
+            int(st_dst.st_mtime) >= int(st_src.st_mtime))
+
+
+def place_tree(src, dst, strategies=PLACEMENT_STRATEGIES):
+    """Place every file below ``src`` in ``dst``, skipping up to date ones."""
+    for path, dirs, files in os.walk(src):
+        outdir = os.path.join(dst, os.path.relpath(path, src))
+        compat.makedirs(outdir)
+        for f in files:
+            if not _is_placed(os.path.join(path, f), os.path.join(outdir, f)):
+                place_file(os.path.join(path, f), os.path.join(outdir, f),
+                           strategies)
+
+
+def copy(src, dst, symlink=False, strategies=PLACEMENT_STRATEGIES):
     """Copy or symlink the file."""
-    func = os.symlink if symlink else shutil.copy2
-    if symlink and os.path.lexists(dst):
-        os.remove(dst)
-    func(src, dst)
+    place_file(src, dst, ('symlink',) if symlink else strategies)
+
+
+def file_digest(filename, blocksize=1 << 20):
+    """Return the SHA-1 hex digest of the content of ``filename``."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
 
 
 def url_from_path(path):
@@ -49,12 +230,14 @@ def url_from_path(path):
 
 # TODO: move to album.py
 def read_markdown(filename):
-    # Use utf-8-sig codec to remove BOM if it is present
-    with codecs.open(filename, 'r', 'utf-8-sig') as f:
-        text = f.read()
+    with instrument.stage('markdown', filename):
+        # Use utf-8-sig codec to remove BOM if it is present
+        with codecs.open(filename, 'r', 'utf-8-sig') as f:
+            text = f.read()
 
-    md = Markdown(extensions=['meta'])
-    html = md.convert(text)
+        from markdown import Markdown
+        md = Markdown(extensions=['meta'])
+        html = md.convert(text)
 
     return {
         'title': md.Meta.get('title', [''])[0],
@@ -26,25 +26,31 @@ from __future__ import with_statement
 import logging
 import os
 import re
-import shutil
 from os.path import splitext
 
-from . import image
-from .utils import call_subprocess
+from . import image, instrument
+from .utils import (atomic_output, call_subprocess, place_file,
+                    PLACEMENT_STRATEGIES, remove_output, Status)
 
 # TODO: merge with image.py
 
+
+class SubprocessException(Exception):
+    pass
+
 def check_subprocess(cmd, source, outname):
     """Run the command to resize the video and remove the output file if the
-    processing fails.
+    processing fails, in which case :class:`SubprocessException` is raised.
 
     """
     logger = logging.getLogger(__name__)
     try:
-        returncode, stdout, stderr = call_subprocess(cmd)
+        with instrument.stage('ffmpeg', source):
+            returncode, stdout, stderr = call_subprocess(cmd)
     except KeyboardInterrupt:
         logger.debug('Process terminated, removing file %s', outname)
-        os.remove(outname)
+        if os.path.exists(outname):
+            os.remove(outname)
         raise
 
     if returncode:
@@ -52,13 +58,16 @@ def check_subprocess(cmd, source, outname):
         logger.debug('STDOUT:\n %s', stdout)
         logger.debug('STDERR:\n %s', stderr)
         logger.debug('Process failed, removing file %s', outname)
-        os.remove(outname)
+        if os.path.exists(outname):
+            os.remove(outname)
+        raise SubprocessException('Failed to process ' + source)
 
 
 def video_size(source):
     """Returns the dimensions of the video."""
 
-    ret, stdout, stderr = call_subprocess(['ffmpeg', '-i', source])
+    with instrument.stage('probe', source):
+        ret, stdout, stderr = call_subprocess(['ffmpeg', '-i', source])
     pattern = re.compile(r'Stream.*Video.* ([0-9]+)x([0-9]+)')
     match = pattern.search(stderr)
 
@@ -69,13 +78,16 @@ def video_size(source):
     return x, y
 
 
-def generate_video(source, outname, size, options=None):
+def generate_video(source, outname, size, options=None,
+                   placement=PLACEMENT_STRATEGIES):
     """Video processor.
 
     :param source: path to a video
     :param outname: path to the generated video
     :param size: size of the resized video `(width, height)`
     :param options: array of options passed to ffmpeg
+    :param placement: strategies used to place a video that needs no
+                      transcoding, see :func:`siglican.utils.place_file`
 
     """
     logger = logging.getLogger(__name__)
@@ -90,7 +102,7 @@ def generate_video(source, outname, size, options=None):
     base, dst_ext = splitext(outname)
     if dst_ext == src_ext and w_src <= w_dst and h_src <= h_dst:
         logger.debug('Video is smaller than the max size, copying it instead')
-        shutil.copy(source, outname)
+        place_file(source, outname, placement)
         return
 
     # http://stackoverflow.com/questions/8218363/maintaining-ffmpeg-aspect-ratio
@@ -108,13 +120,14 @@ def generate_video(source, outname, size, options=None):
 
     # Encoding options improved, thanks to
     # http://ffmpeg.org/trac/ffmpeg/wiki/vpxEncodingGuide
-    cmd = ['ffmpeg', '-i', source, '-y']  # -y to overwrite output files
-    if options is not None:
-        cmd += options
-    cmd += resize_opt + [outname]
+    with atomic_output(outname) as tmp:
+        cmd = ['ffmpeg', '-i', source, '-y']  # -y to overwrite output files
+        if options is not None:
+            cmd += options
+        cmd += resize_opt + [tmp]
 
-    logger.debug('Processing video: %s', ' '.join(cmd))
-    check_subprocess(cmd, source, outname)
+        logger.debug('Processing video: %s', ' '.join(cmd))
+        check_subprocess(cmd, source, tmp)
 
 
 def generate_thumbnail(source, outname, box, fit=True, options=None):
@@ -127,7 +140,7 @@ def generate_thumbnail(source, outname, box, fit=True, options=None):
     cmd = ['ffmpeg', '-i', source, '-an', '-r', '1',
            '-vframes', '1', '-y', tmpfile]
     logger.debug('Create thumbnail for video: %s', ' '.join(cmd))
-    check_subprocess(cmd, source, outname)
+    check_subprocess(cmd, source, tmpfile)
 
     # use the generate_thumbnail function from sigal.image
     image.generate_thumbnail(tmpfile, outname, box, fit, options)
@@ -136,43 +149,31 @@ def generate_thumbnail(source, outname, box, fit=True, options=None):
 
 
 def process_video(filepath, outpath, settings):
-    """Process a video: resize, create thumbnail."""
+    """Process a video: resize, create thumbnail. Returns a
+    :class:`~siglican.utils.Status`."""
 
+    logger = logging.getLogger(__name__)
     filename = os.path.split(filepath)[1]
     basename = splitext(filename)[0]
     outname = os.path.join(outpath, basename + '.webm')
 
-    generate_video(filepath, outname, settings['video_size'],
-                   options=settings['webm_options'])
-
-    if settings['make_thumbs']:
-        thumb_name = os.path.join(outpath, get_thumb(settings, filename))
-        generate_thumbnail(
-            outname, thumb_name, settings['thumb_size'],
-            fit=settings['thumb_fit'], options=settings['jpg_options'])
-
-def get_thumb(settings, filename):
-    """Return the path to the thumb.
-
-    examples:
-    >>> default_settings = create_settings()
-    >>> get_thumb(default_settings, "bar/foo.jpg")
-    "bar/thumbnails/foo.jpg"
-    >>> get_thumb(default_settings, "bar/foo.png")
-    "bar/thumbnails/foo.png"
-
-    for videos, it returns a jpg file:
-    >>> get_thumb(default_settings, "bar/foo.webm")
-    "bar/thumbnails/foo.jpg"
-    """
-
-    path, filen = os.path.split(filename)
-    name, ext = os.path.splitext(filen)
-
-    # TODO: replace this list with Video.extensions github #16
-    if ext.lower() in ('.mov', '.avi', '.mp4', '.webm', '.ogv'):
-        ext = '.jpg'
-    return os.path.join(path, settings['thumb_dir'], settings['thumb_prefix'] +
-                name + settings['thumb_suffix'] + ext)
+    try:
+        generate_video(filepath, outname, settings['SIGLICAN_VIDEO_SIZE'],
+                       options=settings['SIGLICAN_WEBM_OPTIONS'],
+                       placement=settings['SIGLICAN_FILE_PLACEMENT'])
+
+        if settings['SIGLICAN_MAKE_THUMBS']:
+            thumb_name = os.path.join(outpath,
+                                      image.get_thumb(settings, filename))
+            generate_thumbnail(
+                outname, thumb_name, settings['SIGLICAN_THUMB_SIZE'],
+                fit=settings['SIGLICAN_THUMB_FIT'],
+                options=settings['SIGLICAN_JPG_OPTIONS'])
+    except Exception as e:
+        logger.error('Failed to process video %s: %s', filepath, e)
+        remove_output(outname)
+        return Status.FAILURE
+
+    return Status.SUCCESS
 
 
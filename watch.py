@@ -0,0 +1,207 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (c) 2014 - Scott Boone
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Filesystem watchers used by ``python -m siglican watch``.
+
+:func:`watch` returns an inotify watcher on Linux and falls back to polling
+the watched trees elsewhere (or when inotify runs out of watches). Both
+report the paths that changed, not what happened to them: callers rescan the
+directories holding those paths.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# files are reported once written, not when created empty
+_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    """Watch directory trees with inotify, through ctypes."""
+
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK |
+                                           getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.roots = [os.path.abspath(p) for p in paths]
+        self._dirs = {}
+        try:
+            for root in self.roots:
+                self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, path.encode('utf-8')
+                                          if not isinstance(path, bytes)
+                                          else path, _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return  # gone before we got to it
+            raise OSError(err, 'inotify_add_watch failed: %s' % path)
+        self._dirs[wd] = path
+
+    def _add_tree(self, path):
+        for dirpath, dirs, files in os.walk(path, followlinks=True):
+            self._add_watch(dirpath)
+
+    def _read(self, timeout):
+        """Return the paths of the pending events, waiting up to
+        ``timeout`` seconds (forever if None) for the first one."""
+        changed = set()
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return changed
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost: everything may have changed
+                changed.update(self.roots)
+                continue
+            dirpath = self._dirs.get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._dirs[wd]
+                continue
+            path = (os.path.join(dirpath, name.decode('utf-8', 'replace'))
+                    if name else dirpath)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add_tree(path)
+                except OSError as e:
+                    logger.warning("siglican: cannot watch %s: %s", path, e)
+            changed.add(path)
+        return changed
+
+    def wait(self, timeout=None, settle=0.1):
+        """Block until something changes and return the changed paths.
+
+        Events arriving within ``settle`` seconds of each other are
+        reported together, so that copying a batch of photos triggers a
+        single update. Returns an empty set if ``timeout`` expires first.
+        """
+        changed = self._read(timeout)
+        while changed:
+            more = self._read(settle)
+            if not more:
+                break
+            changed |= more
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    """Watch directory trees by comparing their stats at an interval."""
+
+    def __init__(self, paths, interval=1.0):
+        self.roots = [os.path.abspath(p) for p in paths]
+        self.interval = interval
+        self._snapshot = self._stat_trees()
+
+    def _stat_trees(self):
+        snapshot = {}
+        for root in self.roots:
+            for dirpath, dirs, files in os.walk(root, followlinks=True):
+                for name in dirs + files:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def wait(self, timeout=None, settle=0.1):
+        """Block until something changes and return the changed paths, or
+        an empty set if ``timeout`` expires first."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else
+                       max(0, min(self.interval, deadline - time.time())))
+            snapshot = self._stat_trees()
+            old, self._snapshot = self._snapshot, snapshot
+            changed = set(path for path in set(old) | set(snapshot)
+                          if old.get(path) != snapshot.get(path))
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+def watch(paths, interval=1.0):
+    """Return a watcher for the directory trees ``paths``: inotify where
+    available, polling every ``interval`` seconds otherwise."""
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError) as e:
+        logger.info("siglican: inotify unavailable (%s), polling every "
+                    "%gs", e, interval)
+        return PollingWatcher(paths, interval)
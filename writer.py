@@ -33,12 +33,24 @@ import logging
 import os
 import sys
 
-from distutils.dir_util import copy_tree
 from jinja2 import Environment, FileSystemLoader
 from jinja2.exceptions import TemplateNotFound
 
+from . import instrument
+from .assets import write_bundles
 from .pkgmeta import __url__ as sigal_link
-from .utils import url_from_path
+from .utils import (atomic_output, place_tree, url_from_path,
+                    PLACEMENT_STRATEGIES)
+
+
+def _has_content(path, text):
+    """Whether the file ``path`` holds ``text``."""
+    try:
+        with codecs.open(path, 'r', 'utf-8') as f:
+            return f.read() == text
+    except (IOError, OSError, ValueError):
+        return False
+
 
 class Writer(object):
     """Generates html pages for albums and copies static theme files to output."""
@@ -80,13 +92,22 @@ class Writer(object):
         # copy the theme static files in the output dir
         self.theme_path = os.path.join(settings['OUTPUT_PATH'],
                                        self.output_dir,'static')
-        copy_tree(os.path.join(self.theme, 'static'), self.theme_path)
+        with instrument.stage('static'):
+            place_tree(os.path.join(self.theme, 'static'), self.theme_path,
+                       settings.get('SIGLICAN_FILE_PLACEMENT',
+                                    PLACEMENT_STRATEGIES))
+        # fingerprinted bundles of the theme's css and js, see assets
+        self.bundles = {}
+        if settings.get('SIGLICAN_BUNDLE_ASSETS'):
+            with instrument.stage('bundle'):
+                self.bundles = write_bundles(self.theme, self.theme_path)
         
     def generate_context(self, album):
         """Generate the context dict for the given path."""
         
         albumdict = {
                         'SIGLICAN_ALBUM': album,
+                        'SIGLICAN_BUNDLES': self.bundles,
                         'SIGLICAN_INDEX_TITLE': self.index_title,
                         'SIGLICAN_LINK': sigal_link,
                         'SIGLICAN_THEME_NAME': os.path.basename(self.theme),
@@ -100,9 +121,17 @@ class Writer(object):
     def write(self, album):
         """Generate the HTML page and save it."""
 
-        page = self.template.render(**self.generate_context(album))
         output_file = os.path.join(album.dst_path, album.output_file)
-        self.logger.debug("siglican: write output_file: %s",output_file)
+        with instrument.stage('page', album.path):
+            with instrument.stage('render', output_file):
+                page = self.template.render(**self.generate_context(album))
+            if _has_content(output_file, page):
+                # not rewritten, so that publishing does not resend it
+                self.logger.debug("siglican: %s is up to date", output_file)
+                return
+            self.logger.debug("siglican: write output_file: %s",output_file)
 
-        with codecs.open(output_file, 'w', 'utf-8') as f:
-            f.write(page)
\ No newline at end of file
+            with instrument.stage('write', output_file):
+                with atomic_output(output_file) as tmp:
+                    with codecs.open(tmp, 'w', 'utf-8') as f:
+                        f.write(page)
\ No newline at end of file